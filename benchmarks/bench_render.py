@@ -0,0 +1,418 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Secretary render benchmarks
+    Generates synthetic ODT templates of increasing size and times
+    Renderer.render on them, end to end and for every stage of the
+    pipeline. Peak memory of a render is measured with tracemalloc.
+
+    Results are written as JSON, so runs of different releases can be
+    compared:
+        python benchmarks/bench_render.py --output before.json
+        python benchmarks/bench_render.py --output after.json --compare before.json
+
+    With --compare, the exit status is 1 when a scenario is slower than the
+    previous run by more than --threshold.
+
+    The output encoding is compared on the non Latin scenarios with:
+        python benchmarks/bench_render.py -s arabic-1000 -s cjk-1000 --output utf8.json
+        python benchmarks/bench_render.py -s arabic-1000 -s cjk-1000 --ascii-output --compare utf8.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+import zipfile
+import zlib
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import jinja2
+import secretary
+from secretary import Renderer
+
+
+# Every scenario grows one dimension of the template: table rows, input
+# fields per row, distinct images, markdown cells or styles. Some change the
+# script of the rendered text.
+BASE = dict(rows=100, fields=5, images=0, markdown=0, styles=20, text='latin')
+
+SCENARIOS = OrderedDict([
+    ('rows-100',      dict(BASE)),
+    ('rows-1000',     dict(BASE, rows=1000)),
+    ('rows-5000',     dict(BASE, rows=5000)),
+    ('fields-50',     dict(BASE, fields=50)),
+    ('fields-200',    dict(BASE, fields=200)),
+    ('images-10',     dict(BASE, images=10)),
+    ('images-100',    dict(BASE, images=100)),
+    ('markdown-100',  dict(BASE, markdown=1)),
+    ('markdown-1000', dict(BASE, rows=1000, markdown=1)),
+    ('styles-2000',   dict(BASE, styles=2000)),
+    ('styles-20000',  dict(BASE, styles=20000)),
+    ('arabic-1000',   dict(BASE, rows=1000, text='arabic')),
+    ('cjk-1000',      dict(BASE, rows=1000, text='cjk')),
+    ('cyrillic-1000', dict(BASE, rows=1000, text='cyrillic')),
+])
+
+QUICK_SCENARIOS = ('rows-100', 'fields-50', 'images-10', 'markdown-100',
+                   'styles-2000')
+
+NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink" '
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0" '
+    'office:version="1.2"'
+)
+
+TEXT_SAMPLES = {
+    'latin': 'Value %d & <%d>',
+    'arabic': '\u0642\u064a\u0645\u0629 %d & <%d> \u0645\u0631\u062d\u0628\u0627 '
+              '\u0628\u0627\u0644\u0639\u0627\u0644\u0645',
+    'cjk': '\u6570\u503c %d & <%d> \u4f60\u597d\u4e16\u754c\u3002\u62a5\u544a',
+    'cyrillic': '\u0417\u043d\u0430\u0447\u0435\u043d\u0438\u0435 %d & <%d> '
+                '\u043f\u0440\u0438\u0432\u0435\u0442 \u043c\u0438\u0440',
+}
+
+MARKDOWN_SAMPLES = [
+    'Product **%d** is *available* in [our store](http://example.com/%d).\n\n'
+    '* Size: %d cm\n* Color: `blue`\n\n1. Order\n2. Enjoy' % (i, i, i)
+    for i in range(20)
+]
+
+
+# ---- Template generation
+
+def _field(content, description=''):
+    return ('<text:p><text:text-input text:description="%s">%s'
+            '</text:text-input></text:p>' % (description, content))
+
+
+def _cell(content):
+    return ('<table:table-cell office:value-type="string">%s'
+            '</table:table-cell>' % content)
+
+
+def _automatic_styles(count, prefix):
+    return ''.join(
+        '<style:style style:name="%s%d" style:family="text">'
+        '<style:text-properties fo:font-size="%dpt"/></style:style>'
+        % (prefix, i, 8 + i % 10) for i in range(count))
+
+
+def content_xml(fields, images, markdown, styles):
+    """content.xml of a template with a table, repeated by a for loop, with
+    `fields` input fields per row, plus an image and a markdown cell when
+    requested."""
+    cells = [_cell(_field('{{ row.f%d }}' % i)) for i in range(fields)]
+    if images:
+        cells.append(_cell(
+            '<text:p><draw:frame draw:name="{{ row.image|image }}" '
+            'text:anchor-type="as-char" svg:width="1cm" svg:height="1cm">'
+            '<draw:image xlink:href="Pictures/placeholder.png" '
+            'xlink:type="simple" xlink:show="embed" xlink:actuate="onLoad"/>'
+            '</draw:frame></text:p>'))
+    if markdown:
+        cells.append(_cell(_field('{{ row.notes|markdown|safe }}')))
+
+    columns = len(cells)
+    empty_cells = ''.join(_cell('<text:p/>') for i in range(columns - 1))
+
+    return ''.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<office:document-content %s>' % NAMESPACES,
+        '<office:automatic-styles>%s</office:automatic-styles>'
+            % _automatic_styles(styles, 'T'),
+        '<office:body><office:text>',
+        _field('{{ title }}'),
+        '<table:table table:name="Rows">',
+        '<table:table-column table:number-columns-repeated="%d"/>' % columns,
+        '<table:table-row>%s%s</table:table-row>' % (
+            _cell(_field('{% for row in rows %}', 'table-row')), empty_cells),
+        '<table:table-row>%s</table:table-row>' % ''.join(cells),
+        '<table:table-row>%s%s</table:table-row>' % (
+            _cell(_field('{% endfor %}', 'table-row')), empty_cells),
+        '</table:table>',
+        '</office:text></office:body></office:document-content>',
+    ])
+
+
+def styles_xml(styles):
+    """styles.xml with `styles` common and automatic styles and a page
+    header printing a variable."""
+    return ''.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<office:document-styles %s>' % NAMESPACES,
+        '<office:styles>%s</office:styles>' % _automatic_styles(styles, 'S'),
+        '<office:automatic-styles>%s</office:automatic-styles>'
+            % _automatic_styles(styles, 'A'),
+        '<office:master-styles><style:master-page style:name="Standard">',
+        '<style:header>%s</style:header>' % _field('{{ title }}'),
+        '</style:master-page></office:master-styles>',
+        '</office:document-styles>',
+    ])
+
+
+def manifest_xml():
+    entries = [('/', 'application/vnd.oasis.opendocument.text'),
+               ('content.xml', 'text/xml'), ('styles.xml', 'text/xml'),
+               ('Pictures/placeholder.png', 'image/png')]
+
+    return ''.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<manifest:manifest xmlns:manifest='
+        '"urn:oasis:names:tc:opendocument:xmlns:manifest:1.0">',
+        ''.join('<manifest:file-entry manifest:full-path="%s" '
+                'manifest:media-type="%s"/>' % entry for entry in entries),
+        '</manifest:manifest>',
+    ])
+
+
+def png_image(seed, size=64):
+    """A `size` x `size` PNG image, of a color depending on `seed`."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    color = struct.pack('BBB', seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)
+    raw = b''.join(b'\x00' + color * size for y in range(size))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def build_template(rows, fields, images, markdown, styles, text):
+    """Returns the ODT template of a scenario, as bytes."""
+    members = [
+        ('mimetype', 'application/vnd.oasis.opendocument.text'),
+        ('content.xml', content_xml(fields, images, markdown, styles)),
+        ('styles.xml', styles_xml(styles)),
+        ('META-INF/manifest.xml', manifest_xml()),
+    ]
+
+    output = io.BytesIO()
+    archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in members:
+        compress_type = zipfile.ZIP_STORED if name == 'mimetype' else None
+        archive.writestr(name, data.encode('utf-8'), compress_type)
+    archive.writestr('Pictures/placeholder.png', png_image(0))
+    archive.close()
+
+    return output.getvalue()
+
+
+def build_context(rows, fields, images, markdown, styles, text):
+    """Template variables of a scenario."""
+    return {
+        'title': 'Benchmark report',
+        'rows': [
+            dict([('f%d' % i, TEXT_SAMPLES[text] % (row, i))
+                  for i in range(fields)],
+                 image=row % images if images else None,
+                 notes=MARKDOWN_SAMPLES[row % len(MARKDOWN_SAMPLES)])
+            for row in range(rows)
+        ],
+    }
+
+
+def renderer_options(**options):
+    """Return the Renderer arguments of `options` the installed secretary
+    supports, so older releases can be benchmarked too. Older Renderers
+    silently ignore unknown arguments."""
+    supported = {
+        'xml_backend': hasattr(secretary, 'XML_BACKENDS'),
+        'ascii_output': hasattr(Renderer(), 'ascii_output'),
+        'stats_callback': hasattr(secretary, 'RenderStats'),
+    }
+
+    return dict((name, value) for name, value in options.items()
+                if supported[name])
+
+
+def build_renderer(images, xml_backend, ascii_output, stats_callback=None):
+    options = dict(xml_backend=xml_backend, ascii_output=ascii_output)
+    if stats_callback is not None:
+        options['stats_callback'] = stats_callback
+    engine = Renderer(**renderer_options(**options))
+    pictures = dict((i, png_image(i + 1)) for i in range(images))
+
+    @engine.media_loader
+    def loader(value, *args, **kwargs):
+        return (io.BytesIO(pictures[value]), 'image/png')
+
+    return engine
+
+
+# ---- Measures
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_scenario(name, params, repeat, xml_backend, ascii_output=False):
+    template = build_template(**params)
+    context = build_context(**params)
+
+    # End to end
+    times = []
+    for i in range(repeat):
+        engine = build_renderer(params['images'], xml_backend, ascii_output)
+        start = timer()
+        document = engine.render(io.BytesIO(template), **context)
+        times.append(timer() - start)
+
+    # Per stage, as reported by the renderer stats. Releases without them
+    # only report end to end times.
+    reports = []
+    if renderer_options(stats_callback=reports.append):
+        for i in range(repeat):
+            engine = build_renderer(params['images'], xml_backend,
+                                    ascii_output, reports.append)
+            engine.render(io.BytesIO(template), **context)
+
+    stage_times = OrderedDict()
+    for stats in reports:
+        for stage, seconds in stats.phases.items():
+            stage_times.setdefault(stage, []).append(seconds)
+
+    # Peak memory, tracing slows down the render so it is not timed
+    engine = build_renderer(params['images'], xml_backend, ascii_output)
+    tracemalloc.start()
+    try:
+        engine.render(io.BytesIO(template), **context)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    content_size = len(zipfile.ZipFile(io.BytesIO(template)).read('content.xml'))
+    rendered_content_size = zipfile.ZipFile(
+        io.BytesIO(document)).getinfo('content.xml').file_size
+
+    return OrderedDict([
+        ('name', name),
+        ('params', params),
+        ('template_size', len(template)),
+        ('content_size', content_size),
+        ('document_size', len(document)),
+        ('rendered_content_size', rendered_content_size),
+        ('time', OrderedDict([('min', min(times)), ('median', median(times)),
+                              ('runs', times)])),
+        ('stages', OrderedDict((stage, median(values))
+                               for stage, values in stage_times.items())),
+        ('counters', reports[-1].counters if reports else {}),
+        ('peak_memory', peak_memory),
+    ])
+
+
+def compare(results, previous, threshold):
+    """Print the end to end time ratio of every scenario found in both
+    runs. Returns the names of the scenarios slower than `threshold`."""
+    previous = dict((result['name'], result) for result in previous['results'])
+    regressions = []
+
+    for result in results['results']:
+        if result['name'] not in previous:
+            continue
+
+        before = previous[result['name']]
+        ratio = result['time']['median'] / before['time']['median']
+        memory = float(result['peak_memory']) / before['peak_memory']
+        size = float(result['document_size']) / before['document_size']
+        print('%-16s time x%.2f  memory x%.2f  size x%.2f%s' % (
+            result['name'], ratio, memory, size,
+            '  REGRESSION' if ratio > threshold else ''))
+
+        if ratio > threshold:
+            regressions.append(result['name'])
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2].strip())
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='Scenario to run, can be repeated. Defaults to all')
+    parser.add_argument('--quick', action='store_true',
+                        help='Run only the small scenarios')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Renders timed per scenario (default: 3)')
+    parser.add_argument('--xml-backend', default=None,
+                        help='XML backend used by the renderer')
+    parser.add_argument('--ascii-output', action='store_true',
+                        help='Render with ascii_output, non ASCII characters '
+                             'as character references')
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slowdown ratio reported as a regression '
+                             '(default: 1.2)')
+    args = parser.parse_args(argv)
+
+    names = args.scenario or (QUICK_SCENARIOS if args.quick else list(SCENARIOS))
+    xml_backend = args.xml_backend
+    if xml_backend is None:
+        # Older releases have no XML backends, nor the etree module
+        xml_backend = ('lxml' if getattr(secretary, 'etree', None) is not None
+                       else 'minidom')
+
+    results = OrderedDict([
+        ('secretary', getattr(secretary, '__version__', None)),
+        ('jinja2', jinja2.__version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('xml_backend', renderer_options(xml_backend=xml_backend).get(
+            'xml_backend')),
+        ('ascii_output', renderer_options(ascii_output=args.ascii_output).get(
+            'ascii_output', True)),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('repeat', args.repeat),
+        ('results', []),
+    ])
+
+    for name in names:
+        result = run_scenario(name, SCENARIOS[name], args.repeat, xml_backend,
+                              args.ascii_output)
+        results['results'].append(result)
+        print('%-16s %8.3fs  %6.1f MB  %s' % (
+            name, result['time']['median'], result['peak_memory'] / 1048576.0,
+            '  '.join('%s %.3f' % item for item in result['stages'].items())))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            if compare(results, json.load(previous), args.threshold):
+                return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+import sys
+
+# Async rendering uses syntax and asyncio.run, added in Python 3.7
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_secretary_async.py')
@@ -25,16 +25,52 @@ Secretary
 from __future__ import unicode_literals, print_function
 
 import io
+import os
+import errno
+import base64
 import re
 import sys
+import json
+import time
+import tempfile
+import threading
+import struct
 import logging
 import zipfile
+import zlib
+from itertools import chain
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from hashlib import sha1
 from os import path
+from timeit import default_timer as timer
 from mimetypes import guess_type, guess_extension
 from uuid import uuid4
 from xml.dom.minidom import parseString
-from xml.parsers.expat import ExpatError, ErrorString
-from jinja2 import Environment, Undefined
+from xml.sax.saxutils import escape as xml_escape
+from xml.parsers.expat import ExpatError, ErrorString, ParserCreate
+from jinja2 import Environment, FileSystemBytecodeCache, Undefined
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
 try:
     if sys.version_info.major == 3:
@@ -45,6 +81,9 @@ except AttributeError:
     if not isinstance(sys.version_info, tuple):
         raise
 
+# ZipFile takes a compression level from Python 3.7
+ZIP_COMPRESSLEVEL = sys.version_info >= (3, 7)
+
 
 FLOW_REFERENCES = {
     'text:p'             : 'text:p',
@@ -69,6 +108,19 @@ FLOW_REFERENCES = {
     'after::cell'        : 'table:table-cell',
 }
 
+__version__ = '0.2.14'
+
+# Text nodes without attributes nor children in rendered documents. Only
+# those with line feeds or tabs are rewritten. The text can not contain
+# tags, so every character is scanned once.
+ESCAPE_CHARS_PATTERN = re.compile(r'<text:([^\s>/]+)>([^<>]*)</text:\1>')
+
+# Characters of content.xml rendered at once by stream_to
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Archive members modified when rendering a template
+RENDERED_FILES = ('content.xml', 'styles.xml', 'META-INF/manifest.xml')
+
 # ---- Exceptions
 class SecretaryError(Exception):
     pass
@@ -102,6 +154,941 @@ def pad_string(value, length=5):
     value = str(value)
     return value.zfill(length)
 
+
+class LRUCache(object):
+    """
+        A least recently used cache bounded by the total size of its values.
+        Values larger than `max_size` are never cached. A `max_size` of 0
+        disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the value of `key` and mark it as recently used."""
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+
+            self._items[key] = (value, size)
+            return value
+
+    def set(self, key, value, size):
+        """Store `value`, whose size is `size`, under `key`. Least recently
+        used values are discarded until the cache fits in max_size."""
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+
+            self._items[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_size:
+                self.size -= self._items.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class RenderState(object):
+    """
+        State of a render: the members of the document being rendered, the
+        images found by the image filter, the content and manifest xml
+        objects, etc. Every thread, and every asyncio task, rendering with
+        a Renderer has its own state, so a single Renderer can be shared by
+        all of them.
+    """
+
+    def __init__(self, stats=None):
+        self.files = {}
+        self.render_vars = {}
+        self.template_images = {}
+        self.pack_stats = []
+        self.stats = stats
+
+        self.content = self.content_source = None
+        self.manifest = self.manifest_source = None
+        self.automatic_styles = self.automatic_styles_node = None
+
+        # Set while content.xml is being streamed, see
+        # CompiledTemplate.stream_to
+        self.streaming = False
+
+        # Rendering a Flat ODF template, media is inlined in the document
+        self.flat = False
+
+
+class _ThreadRenderState(threading.local):
+    # Stand in for contextvars.ContextVar on Pythons without contextvars:
+    # the value is kept for each thread
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+# (renderer, RenderState) pair of the render running in the current thread
+# or asyncio task, or None
+if contextvars is not None:
+    _current_render = contextvars.ContextVar('secretary_render_state',
+                                             default=None)
+else:
+    _current_render = _ThreadRenderState()
+
+
+class _RenderStateAttribute(object):
+    # Renderer attribute kept in the state of the current render
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, renderer, owner):
+        if renderer is None:
+            return self
+
+        return getattr(renderer._render_state, self.name)
+
+    def __set__(self, renderer, value):
+        setattr(renderer._render_state, self.name, value)
+
+class RenderStats(object):
+    """
+        Wall time spent on every phase of a compile or a render, and
+        counters of what was done. When a Renderer has a stats_callback,
+        it receives one of these after every compile and render. Renders
+        of a template given as a file include its compile.
+
+        Phases:
+            unpack, parse, prepare, compile: Reading the template archive,
+                parsing its xml files, preparing jinja tags and compiling
+                the jinja templates.
+            render: Rendering the jinja templates.
+            encode_escape_chars: Encoding line feeds and tabs of the
+                rendered xml.
+            parse_rendered, replace_images, serialize, check_xml: Post
+                render work on the rendered xml.
+            media_loader: Calls to the media loader. Also included in
+                replace_images.
+            pack: Writing the document archive.
+
+        Counters:
+            fields, images, media_cache_hits, markdown_calls,
+            markdown_cache_hits, template_cache_hits and output_bytes (when
+            the output file object supports tell).
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.total = 0.0
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def as_dict(self):
+        """Return the stats as a dict, i.e. to be sent as JSON."""
+        return {
+            'operation': self.operation,
+            'total': self.total,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+        }
+
+# ************************************************
+#
+#           MARKDOWN
+#
+# ************************************************
+
+class MarkdownWriter(HTMLParser):
+    """
+        Writes the ODT XML of the HTML produced by markdown2, while it is
+        parsed. HTML tags are translated as specified in a transform map
+        (see markdown_map.transform_map), tags not in the map are copied.
+        The HTML does not need to be well formed XML.
+
+        Basic use example:
+            writer = MarkdownWriter(transform_map)
+            writer.feed(html_text)
+            writer.close()
+            odt_text, styles = writer.getvalue(), writer.styles
+    """
+
+    # HTML elements without end tag
+    void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'wbr'])
+
+    def __init__(self, transform_map):
+        HTMLParser.__init__(self)
+        self.transform_map = transform_map
+        self.styles = []        # (name, attributes, properties) of used styles
+        self._style_names = set()
+        self._output = []
+        self._chunk = []        # Output of the current top level node
+        self._stack = []        # [tag, end tag, wraps its children in text:p]
+        self._start_tag = None  # Written once we know if the node is empty
+        self._item_start = False
+        self._preformatted = False
+
+    def _write_start_tag(self):
+        if self._start_tag is not None:
+            self._chunk.append(self._start_tag + '>')
+            self._start_tag = None
+
+    def _begin_child(self, tag=None):
+        # Called before writing any child node
+        self._write_start_tag()
+
+        if self._item_start:
+            # ODT list items can not have text directly. Wrap their content
+            # in a text:p node, unless markdown2 already did it.
+            self._item_start = False
+            if tag != 'p':
+                self._chunk.append('<text:p>')
+                self._stack[-1][2] = True
+
+    def _end_top_level_node(self):
+        result = ''.join(self._chunk)
+        self._chunk = []
+
+        # linebreaks in preformated nodes should be converted to <text:line-break/>
+        if self._preformatted:
+            result = result.replace('\n', '<text:line-break/>')
+            self._preformatted = False
+
+        # All double linebreak should be replaced with an empty paragraph
+        self._output.append(
+            result.replace('\n\n', '<text:p text:style-name="Standard"/>'))
+
+    def handle_starttag(self, tag, attrs):
+        if not self._stack and self._chunk:
+            self._end_top_level_node()
+        self._begin_child(tag)
+
+        if tag in ('ul', 'ol') and self._stack and self._stack[-1][2]:
+            # Nested lists can not be inside the text:p of their list item
+            self._chunk.append('</text:p>')
+            self._stack[-1][2] = False
+
+        rule = self.transform_map.get(tag)
+        if rule is None:
+            odt_tag, odt_attrs = tag, [(k, v or '') for k, v in attrs]
+        else:
+            odt_tag = rule['replace_with']
+            odt_attrs = [('text:%s' % k, v) for k, v in
+                         rule.get('style_attributes', {}).items()]
+            for k, v in rule.get('attributes', {}).items():
+                # copy original href attribute in <a> tag
+                if tag == 'a' and k == 'xlink:href':
+                    v = dict(attrs).get('href') or v
+                odt_attrs.append((k, v))
+
+            style = rule.get('style')
+            if style and style['name'] not in self._style_names:
+                self._style_names.add(style['name'])
+                self.styles.append((style['name'],
+                                    style.get('attributes', None),
+                                    style['properties']))
+
+        if not self._stack:
+            self._preformatted = ('text:style-name',
+                                  'Preformatted_20_Text') in odt_attrs
+
+        self._start_tag = '<' + odt_tag + ''.join(
+            ' %s=%s' % (k, xml_escape(v, {'"': '&quot;'}).join('""'))
+            for k, v in odt_attrs)
+        self._stack.append([tag, '</%s>' % odt_tag, False])
+        self._item_start = (tag == 'li' and rule is not None)
+
+        if tag in self.void_tags:
+            self.handle_endtag(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.void_tags:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in [node[0] for node in self._stack]:
+            # Stray end tag
+            return
+
+        while self._stack:
+            node_tag, end_tag, wrapped = self._stack.pop()
+            self._item_start = False
+            if self._start_tag is not None:
+                self._chunk.append(self._start_tag + '/>')
+                self._start_tag = None
+            else:
+                self._chunk.append('</text:p>' + end_tag if wrapped else end_tag)
+
+            if node_tag == tag:
+                break
+
+        if not self._stack:
+            self._end_top_level_node()
+
+    def handle_data(self, data):
+        self._begin_child()
+        self._chunk.append(xml_escape(data, {'"': '&quot;'}))
+
+    def handle_entityref(self, name):
+        # Only called by Python 2 parsers
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        # Only called by Python 2 parsers
+        self.handle_data(self.unescape('&#%s;' % name))
+
+    def handle_comment(self, data):
+        self._begin_child()
+        self._chunk.append('<!--%s-->' % data)
+
+    def close(self):
+        HTMLParser.close(self)
+        if self._stack:
+            self.handle_endtag(self._stack[0][0])
+        elif self._chunk:
+            self._end_top_level_node()
+
+    def getvalue(self):
+        """Return the ODT XML written so far."""
+        return ''.join(self._output)
+
+
+# ************************************************
+#
+#           XML BACKENDS
+#
+# ************************************************
+
+class MinidomDocument(object):
+    """
+        XML document implemented with xml.dom.minidom. Used when lxml is not
+        installed.
+
+        XML documents provide the few operations secretary needs to prepare
+        templates and replace images: parsing, tag lookup, ancestor search,
+        node replacement and serialization. Nodes and attributes are named
+        using prefixed names, like 'text:p'.
+    """
+
+    def __init__(self, xml):
+        self.document = parseString(xml)
+
+    def iter(self, tag):
+        """Returns every node of type `tag`, in document order."""
+        return self.document.getElementsByTagName(tag)
+
+    def tag(self, node):
+        return node.nodeName
+
+    def parent(self, node):
+        """Returns the parent element of `node` or None."""
+        parent = node.parentNode
+        if parent is None or parent.nodeType != parent.ELEMENT_NODE:
+            return None
+
+        return parent
+
+    def ancestors(self, node):
+        """Returns the ancestor elements of `node`, from its parent up to
+        the root element."""
+        ancestors = []
+        node = self.parent(node)
+        while node is not None:
+            ancestors.append(node)
+            node = self.parent(node)
+
+        return ancestors
+
+    def first_child(self, node):
+        return node.firstChild
+
+    def text(self, node):
+        """Returns the text before the first child element of `node`, or
+        None if `node` does not start with text."""
+        child = node.firstChild
+        if child is None or child.nodeType != child.TEXT_NODE:
+            return None
+
+        return child.data
+
+    def get(self, node, name):
+        return node.getAttribute(name)
+
+    def set(self, node, name, value):
+        node.setAttribute(name, value)
+
+    def attributes(self, node):
+        """Returns the attributes of node as a dict"""
+        attrs = dict()
+        for i in xrange(node.attributes.length):
+            attr = node.attributes.item(i)
+            attrs[attr.name] = attr.value
+
+        return attrs
+
+    def insert_text(self, node, text, after=False):
+        """Insert `text` before, or after, `node`."""
+        text_node = self.document.createTextNode(text)
+        if after:
+            node.parentNode.insertBefore(text_node, node.nextSibling)
+        else:
+            node.parentNode.insertBefore(text_node, node)
+
+    def insert_span(self, node, text):
+        """Insert a <text:span> node with `text` before `node`."""
+        span = self.document.createElement('text:span')
+        span.appendChild(self.document.createTextNode(text))
+        node.parentNode.insertBefore(span, node)
+
+    def remove_attribute(self, node, name):
+        if node.hasAttribute(name):
+            node.removeAttribute(name)
+
+    def replace_children(self, node, tag, text):
+        """Replace the children of `node` with a `tag` node holding
+        `text`."""
+        while node.firstChild is not None:
+            node.removeChild(node.firstChild)
+
+        child = self.document.createElement(tag)
+        child.appendChild(self.document.createTextNode(text))
+        node.appendChild(child)
+
+    def remove(self, node):
+        node.parentNode.removeChild(node)
+
+    def serialize(self):
+        return self.document.toxml()
+
+
+class LxmlDocument(object):
+    """
+        XML document implemented with lxml. Faster and lighter than
+        MinidomDocument on big documents. See MinidomDocument for the
+        operations it provides.
+    """
+
+    def __init__(self, xml):
+        # Like minidom, accept repeated xml:id values. The markdown filter
+        # outputs lists with the same id.
+        parser = etree.XMLParser(resolve_entities=False, huge_tree=True,
+                                 collect_ids=False)
+        try:
+            self.root = etree.fromstring(xml, parser)
+        except etree.XMLSyntaxError as e:
+            # Raise the same exception as xml.dom.minidom
+            error = ExpatError(e.msg)
+            error.lineno, error.offset = e.position
+            raise error
+
+        self.namespaces = dict((prefix, uri) for prefix, uri in
+                               self.root.nsmap.items() if prefix)
+        self.namespaces['xml'] = 'http://www.w3.org/XML/1998/namespace'
+        self.prefixes = dict((uri, prefix) for prefix, uri in
+                             self.namespaces.items())
+        self._names = {}
+
+    def _clark_name(self, name, node=None):
+        # Returns {namespace}name notation of prefixed `name`, or None if
+        # its prefix is not declared by the root element, nor in scope of
+        # `node`.
+        try:
+            clark_name = self._names[name]
+        except KeyError:
+            prefix, _, local = name.rpartition(':')
+            if not prefix:
+                clark_name = local
+            elif prefix in self.namespaces:
+                clark_name = '{%s}%s' % (self.namespaces[prefix], local)
+            else:
+                clark_name = None
+
+            self._names[name] = clark_name
+
+        if clark_name is None and node is not None:
+            # Namespace declared by a descendant of the root element
+            prefix, _, local = name.rpartition(':')
+            uri = node.nsmap.get(prefix)
+            if uri is not None:
+                return '{%s}%s' % (uri, local)
+
+        return clark_name
+
+    def _prefixed_name(self, clark_name, node):
+        if not clark_name.startswith('{'):
+            return clark_name
+
+        uri, local = clark_name[1:].split('}', 1)
+        prefix = self.prefixes.get(uri)
+        if prefix is None:
+            # Namespace declared by a descendant of the root element
+            prefix = next((prefix for prefix, node_uri in node.nsmap.items()
+                           if node_uri == uri), None)
+
+        return '%s:%s' % (prefix, local) if prefix else local
+
+    def iter(self, tag):
+        clark_name = self._clark_name(tag)
+        if clark_name is None:
+            # Its prefix may be declared below the root element
+            return [node for node in self.root.iter(etree.Element)
+                    if self.tag(node) == tag]
+
+        return list(self.root.iter(clark_name))
+
+    def tag(self, node):
+        return self._prefixed_name(node.tag, node)
+
+    def parent(self, node):
+        return node.getparent()
+
+    def ancestors(self, node):
+        return list(node.iterancestors())
+
+    def first_child(self, node):
+        return node[0] if len(node) else None
+
+    def text(self, node):
+        return node.text
+
+    def get(self, node, name):
+        name = self._clark_name(name, node)
+        return node.get(name, '') if name else ''
+
+    def set(self, node, name, value):
+        node.set(self._clark_name(name, node), value)
+
+    def attributes(self, node):
+        return dict((self._prefixed_name(name, node), value)
+                    for name, value in node.attrib.items())
+
+    def _append_text(self, node, text):
+        # Append text just before `node`. In lxml text is not a node, but
+        # the tail of the previous sibling or the text of the parent.
+        previous = node.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + text
+        else:
+            parent = node.getparent()
+            parent.text = (parent.text or '') + text
+
+    def insert_text(self, node, text, after=False):
+        if after:
+            node.tail = text + (node.tail or '')
+        else:
+            self._append_text(node, text)
+
+    def insert_span(self, node, text):
+        # Create the span as child of parent, so it uses the namespace
+        # prefixes declared in the document
+        parent = node.getparent()
+        span = etree.SubElement(parent, self._clark_name('text:span', parent))
+        span.text = text
+        node.addprevious(span)
+
+    def remove_attribute(self, node, name):
+        name = self._clark_name(name, node)
+        if name is not None:
+            node.attrib.pop(name, None)
+
+    def replace_children(self, node, tag, text):
+        for child in list(node):
+            node.remove(child)
+
+        node.text = None
+        child = etree.SubElement(node, self._clark_name(tag, node))
+        child.text = text
+
+    def remove(self, node):
+        if node.tail:
+            self._append_text(node, node.tail)
+
+        node.getparent().remove(node)
+
+    def serialize(self):
+        return '<?xml version="1.0" ?>' + etree.tostring(self.root,
+                                                        encoding='unicode')
+
+
+class StreamedNode(object):
+    # Node of a StreamedDocument: its number in document order, tag and,
+    # for indexed nodes, attributes, leading text and ancestors
+    __slots__ = ('number', 'tag', 'attributes', 'text', 'ancestors')
+
+    def __init__(self, number, tag):
+        self.number = number
+        self.tag = tag
+        self.attributes = self.text = self.ancestors = None
+
+
+class StreamedDocument(object):
+    """
+        XML document read with expat events, for templates too big to be
+        built into a xml object. Only text:text-input nodes and their
+        ancestors are kept, so memory use depends on the number of fields
+        and nesting depth, not on the size of the document.
+
+        It can only be used to prepare templates: node insertions and
+        removals are recorded, and applied by serialize, which reads the
+        xml again and writes it with them. The text is the same LxmlDocument
+        serializes.
+    """
+
+    INDEXED_TAGS = ('text:text-input',)
+
+    def __init__(self, xml):
+        self.xml = xml
+        self._nodes = dict((tag, []) for tag in self.INDEXED_TAGS)
+        self._before = {}       # node number: nodes inserted before it
+        self._after = {}        # node number: nodes inserted after it
+        self._removed = set()   # numbers of removed nodes
+
+        self._count = 0
+        self._stack = []
+        self._text_of = None    # indexed node whose leading text is read
+
+        parser = self._parser()
+        parser.StartElementHandler = self._index_start
+        parser.EndElementHandler = self._index_end
+        parser.CharacterDataHandler = self._index_text
+        parser.CommentHandler = self._end_text
+        parser.ProcessingInstructionHandler = self._end_text
+        parser.Parse(xml, True)
+
+        self._stack = None
+
+    @staticmethod
+    def _parser():
+        parser = ParserCreate()
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        return parser
+
+    def _end_text(self, *args):
+        # The leading text of an indexed node ends at its first child
+        node = self._text_of
+        if node is not None:
+            node.text = ''.join(node.text) if node.text else None
+            self._text_of = None
+
+    def _index_start(self, tag, attributes):
+        self._end_text()
+        node = StreamedNode(self._count, tag)
+        self._count += 1
+
+        if tag in self._nodes:
+            node.attributes = dict(zip(attributes[::2], attributes[1::2]))
+            node.ancestors = self._stack[::-1]
+            node.text = []
+            self._text_of = node
+            self._nodes[tag].append(node)
+
+        self._stack.append(node)
+
+    def _index_end(self, tag):
+        self._end_text()
+        self._stack.pop()
+
+    def _index_text(self, data):
+        if self._text_of is not None:
+            self._text_of.text.append(data)
+
+    def iter(self, tag):
+        """Returns every node of type `tag`, in document order. Only tags in
+        INDEXED_TAGS can be looked up."""
+        return list(self._nodes[tag])
+
+    def tag(self, node):
+        return node.tag
+
+    def parent(self, node):
+        return node.ancestors[0] if node.ancestors else None
+
+    def ancestors(self, node):
+        return list(node.ancestors)
+
+    def text(self, node):
+        return node.text
+
+    def get(self, node, name):
+        return node.attributes.get(name, '')
+
+    def attributes(self, node):
+        return dict(node.attributes)
+
+    def _check_attached(self, node):
+        # Like the other backends, fail on nodes already removed
+        if node.number in self._removed:
+            raise SecretaryError('Node %s was removed from the document' %
+                                 node.tag)
+
+    def insert_text(self, node, text, after=False):
+        self._check_attached(node)
+        if after:
+            self._after.setdefault(node.number, []).insert(0, (None, text))
+        else:
+            self._before.setdefault(node.number, []).append((None, text))
+
+    def insert_span(self, node, text):
+        self._check_attached(node)
+        self._before.setdefault(node.number, []).append(('text:span', text))
+
+    def remove(self, node):
+        self._check_attached(node)
+        self._removed.add(node.number)
+
+    def serialize(self):
+        writer = _StreamedDocumentWriter(self._before, self._after,
+                                         self._removed)
+        parser = self._parser()
+        parser.StartElementHandler = writer.start
+        parser.EndElementHandler = writer.end
+        parser.CharacterDataHandler = writer.text
+        parser.CommentHandler = writer.comment
+        parser.ProcessingInstructionHandler = writer.processing_instruction
+        parser.Parse(self.xml, True)
+
+        return writer.output.getvalue()
+
+
+class _StreamedDocumentWriter(object):
+    # Expat handlers writing a StreamedDocument with its recorded changes.
+    # Text is escaped, and nodes without content closed, like lxml does.
+    def __init__(self, before, after, removed):
+        self.before = before
+        self.after = after
+        self.removed = removed
+        self.output = io.StringIO()
+        self.output.write('<?xml version="1.0" ?>')
+        self.count = 0
+        self.stack = []         # numbers of the open nodes
+        self.skip = None        # depth of the removed node being skipped
+        self.pending = False    # the last start tag is not closed yet
+
+    def _open(self):
+        # Close the start tag of the current node, it has content
+        if self.pending:
+            self.output.write('>')
+            self.pending = False
+
+    def _write_inserted(self, nodes):
+        if nodes:
+            self._open()
+
+        for tag, text in nodes or ():
+            text = xml_escape(text, {'\r': '&#13;'})
+            if tag is None:
+                self.output.write(text)
+            else:
+                self.output.write('<%s>%s</%s>' % (tag, text, tag))
+
+    def start(self, tag, attributes):
+        number = self.count
+        self.count += 1
+        self.stack.append(number)
+        if self.skip is not None:
+            return
+
+        self._write_inserted(self.before.get(number))
+        if number in self.removed:
+            self.skip = len(self.stack)
+            return
+
+        self._open()
+        names = attributes[::2]
+        values = attributes[1::2]
+        # Namespace declarations are written first, as lxml does
+        order = sorted(range(len(names)), key=lambda i: not (
+            names[i] == 'xmlns' or names[i].startswith('xmlns:')))
+
+        self.output.write('<' + tag)
+        for i in order:
+            self.output.write(' %s=%s' % (names[i], xml_escape(values[i], {
+                '"': '&quot;', '\n': '&#10;', '\t': '&#9;', '\r': '&#13;'
+            }).join('""')))
+        self.pending = True
+
+    def end(self, tag):
+        number = self.stack.pop()
+        if self.skip is not None:
+            if self.skip <= len(self.stack):
+                return
+            self.skip = None
+        elif self.pending:
+            self.output.write('/>')
+            self.pending = False
+        else:
+            self.output.write('</%s>' % tag)
+
+        self._write_inserted(self.after.get(number))
+
+    def _writing(self):
+        # Only nodes of the root element, not being removed, are written
+        return self.stack and self.skip is None
+
+    def text(self, data):
+        if self._writing():
+            self._open()
+            self.output.write(xml_escape(data, {'\r': '&#13;'}))
+
+    def comment(self, data):
+        if self._writing():
+            self._open()
+            self.output.write('<!--%s-->' % data)
+
+    def processing_instruction(self, target, data):
+        if self._writing():
+            self._open()
+            self.output.write('<?%s %s?>' % (target, data) if data else
+                               '<?%s?>' % target)
+
+
+XML_BACKENDS = {
+    'minidom': MinidomDocument,
+    'lxml': LxmlDocument,
+}
+
+
+class CompressionPolicy(object):
+    """
+        Tells how new members of rendered documents are compressed. Members
+        whose extension is in `stored_extensions`, usually media which is
+        already compressed, are stored. Other members are deflated with
+        compression `level`, from 1 (fastest) to 9 (smallest). When `level`
+        is None, or before Python 3.7, zlib's default level is used.
+        `store_all` stores every member, useful for documents converted
+        right away to another format.
+    """
+
+    STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.tif', '.tiff',
+                         '.webp', '.zip', '.gz', '.odt', '.ods', '.odp')
+
+    def __init__(self, level=None, store_all=False,
+                 stored_extensions=STORED_EXTENSIONS):
+        self.level = level
+        self.store_all = store_all
+        self.stored_extensions = stored_extensions
+
+    def compression_for(self, name):
+        """Returns a (compress_type, compress_level) tuple for member
+        `name`."""
+        # OpenDocument requires the mimetype member to be stored
+        if self.store_all or name == 'mimetype' or \
+           path.splitext(name)[1].lower() in self.stored_extensions:
+            return zipfile.ZIP_STORED, None
+
+        return zipfile.ZIP_DEFLATED, self.level
+
+
+# Compression profiles for Renderer's `compression` argument
+COMPRESSION_PROFILES = {
+    'default': CompressionPolicy(),
+    'small'  : CompressionPolicy(level=9),
+    'fast'   : CompressionPolicy(store_all=True),
+}
+
+
+class RawZipMember(object):
+    """
+        A member of a ZIP archive kept as its raw, still compressed, data.
+        It can be written into another archive without being decompressed
+        and compressed again.
+    """
+
+    def __init__(self, info, data):
+        self.info = info
+        self.data = data
+
+    @classmethod
+    def read(cls, archive, info):
+        """Read the raw data of member `info` of ZipFile `archive`"""
+        archive.fp.seek(info.header_offset)
+        header = archive.fp.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        archive.fp.seek(info.header_offset + zipfile.sizeFileHeader +
+                        name_length + extra_length)
+
+        return cls(info, archive.fp.read(info.compress_size))
+
+    def uncompressed(self):
+        """Returns the data of this member, decompressed"""
+        if self.info.compress_type == zipfile.ZIP_STORED:
+            return self.data
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(self.data, -zlib.MAX_WBITS)
+
+        raise SecretaryError('Unsupported compression method %s of %s' % (
+            self.info.compress_type, self.info.filename))
+
+    def write(self, zipdoc):
+        """Write this member into ZipFile `zipdoc`"""
+        info = copy(self.info)
+
+        # The raw data is appended by updating the internal state of
+        # ZipFile (start_dir, _didModify, filelist and NameToInfo), as
+        # zipfile has no API for it. start_dir exists from Python 3.5; on
+        # older versions the member is compressed again by writestr.
+        if not hasattr(zipdoc, 'start_dir'):
+            zipdoc.writestr(info, self.uncompressed())
+            return
+
+        # CRC and sizes are known, so they go in the local header instead
+        # of a data descriptor
+        info.flag_bits &= ~0x08
+
+        if getattr(zipdoc, '_seekable', True):
+            zipdoc.fp.seek(zipdoc.start_dir)
+
+        info.header_offset = zipdoc.fp.tell()
+        zipdoc.fp.write(info.FileHeader())
+        zipdoc.fp.write(self.data)
+
+        zipdoc.filelist.append(info)
+        zipdoc.NameToInfo[info.filename] = info
+        zipdoc.start_dir = zipdoc.fp.tell()
+        zipdoc._didModify = True
+
+
+class StreamedZipMember(object):
+    """
+        A member of a ZIP archive whose data, an iterable of byte strings,
+        is produced while it is written. The member is never kept whole in
+        memory. Members over 2 GiB need `zip64`, ZIP64 sizes in their
+        local header, as their size is not known up front.
+    """
+
+    def __init__(self, chunks, zip64=False):
+        self.chunks = chunks
+        self.zip64 = zip64
+
+
 class Renderer(object):
     """
         Main engine to convert and ODT document into a jinja
@@ -119,6 +1106,18 @@ class Renderer(object):
             result = engine.render('template.odt', var1=val1, ...)
     """
 
+    # Per render state. See RenderState.
+    files = _RenderStateAttribute('files')
+    render_vars = _RenderStateAttribute('render_vars')
+    template_images = _RenderStateAttribute('template_images')
+    _stats = _RenderStateAttribute('stats')
+    _content = _RenderStateAttribute('content')
+    _content_source = _RenderStateAttribute('content_source')
+    _manifest = _RenderStateAttribute('manifest')
+    _manifest_source = _RenderStateAttribute('manifest_source')
+    _automatic_styles = _RenderStateAttribute('automatic_styles')
+    _automatic_styles_node = _RenderStateAttribute('automatic_styles_node')
+
     def __init__(self, environment=None, **kwargs):
         """
         Create a Renderer instance.
@@ -127,10 +1126,56 @@ class Renderer(object):
             environment: Use this jinja2 environment. If not specified, we
                          create a new environment for this class instance.
 
+        kwargs:
+            media_path: Path used by the file system loader to load images.
+            media_cache_size: Size in bytes of the cache of images returned
+                              by the media loader. The cache is shared by
+                              every render of this instance and keyed by
+                              the image value and arguments, so use it only
+                              when the loader always returns the same image
+                              for them. Defaults to 0, disabled.
+            markdown_cache_size: Size in bytes of the cache of markdown
+                                 filter conversions, shared by every render
+                                 of this instance. Defaults to 1 MB, use 0
+                                 to disable it.
+            compression: How rendered documents are compressed. A name in
+                         COMPRESSION_PROFILES ('default', 'small' or
+                         'fast') or a CompressionPolicy instance.
+            xml_backend: XML implementation used to prepare templates and
+                         replace images. A name in XML_BACKENDS, 'lxml' or
+                         'minidom'. Defaults to lxml when it is installed.
+            streaming_prepare: Read templates with an event based parser
+                               when preparing them, instead of building a
+                               xml object of every xml file. It keeps only
+                               the fields and their ancestors, so it uses
+                               much less memory on huge templates, and the
+                               prepared template is the same. Defaults to
+                               False.
+            check_xml: Check that rendered XML documents are well formed.
+                       The check is done with a streaming expat parser, no
+                       xml object is built for it. Defaults to False.
+            stats_callback: Function called with a RenderStats instance
+                            after every compile and render. Stats are not
+                            collected when it is not given.
+            ascii_output: Write non ASCII characters of rendered xml files
+                          as character references (i.e. &#1605;) instead of
+                          UTF-8, for consumers that only read ASCII.
+                          Documents in non Latin scripts grow several times
+                          in size with it.
+            cache_dir: Directory where prepared templates and their jinja
+                       bytecode are kept, so other processes, or later
+                       runs, compile the same template faster. Entries are
+                       keyed by the template xml files and secretary
+                       version. Do not share it between renderers with
+                       different jinja environment settings.
+
         """
         self.log = logging.getLogger(__name__)
         self.log.debug('Initing a Renderer instance\nTemplate')
 
+        # pack_stats of the last render of each thread
+        self._last_render = threading.local()
+
         if environment:
             self.environment = environment
         else:
@@ -142,11 +1187,150 @@ class Renderer(object):
             self.environment.filters['image'] = self.image_filter
 
         self.media_path = kwargs.pop('media_path', '')
+        self.check_xml = kwargs.pop('check_xml', False)
         self.media_callback = self.fs_loader
+        self.media_cache = LRUCache(kwargs.pop('media_cache_size', 0))
+        self.markdown_cache = LRUCache(kwargs.pop('markdown_cache_size',
+                                                  1024 * 1024))
+        self.compression = kwargs.pop('compression', 'default')
+        if not isinstance(self.compression, CompressionPolicy):
+            try:
+                self.compression = COMPRESSION_PROFILES[self.compression]
+            except KeyError:
+                raise SecretaryError('Unknown compression profile "%s"' %
+                                     self.compression)
+
+        self.stats_callback = kwargs.pop('stats_callback', None)
+
+        self.ascii_output = kwargs.pop('ascii_output', False)
+
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        self.bytecode_cache = None
+        if self.cache_dir is not None:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not path.isdir(self.cache_dir):
+                    raise
+            self.bytecode_cache = FileSystemBytecodeCache(
+                self.cache_dir, 'secretary-%s.jinja')
+
+        xml_backend = kwargs.pop('xml_backend', None)
+        if xml_backend is None:
+            xml_backend = 'lxml' if etree is not None else 'minidom'
+        if xml_backend == 'lxml' and etree is None:
+            raise SecretaryError('Could not import lxml library. Install it using "pip install lxml"')
+        try:
+            self.xml_document = XML_BACKENDS[xml_backend]
+        except KeyError:
+            raise SecretaryError('Unknown XML backend "%s"' % xml_backend)
+
+        # XML implementation used to prepare templates
+        self.template_document = self.xml_document
+        if kwargs.pop('streaming_prepare', False):
+            self.template_document = StreamedDocument
 
         self._compile_tags_expressions()
 
 
+    def _current_state(self):
+        # RenderState of the render this renderer runs in the current
+        # thread or asyncio task, or None
+        current = _current_render.get()
+        if current is not None and current[0] is self:
+            return current[1]
+
+        return None
+
+    @property
+    def _render_state(self):
+        # RenderState of the current render. Outside of a render, a new
+        # state that is not kept.
+        state = self._current_state()
+        return state if state is not None else RenderState()
+
+    @contextmanager
+    def _new_render_state(self):
+        # Run a compile or a render with a new state. Stats being collected
+        # are shared with the new state, and pack_stats are kept after it.
+        previous = self._current_state()
+        state = RenderState(stats=previous and previous.stats)
+        token = _current_render.set((self, state))
+        try:
+            yield state
+        finally:
+            _current_render.reset(token)
+            if previous is not None:
+                previous.pack_stats = state.pack_stats
+            else:
+                self._last_render.pack_stats = state.pack_stats
+
+    @property
+    def pack_stats(self):
+        """Size, compressed size and time spent on every member of the
+        document being packed or, after a render, of the last document
+        rendered by the current thread."""
+        state = self._current_state()
+        if state is not None:
+            return state.pack_stats
+
+        return getattr(self._last_render, 'pack_stats', [])
+
+    @pack_stats.setter
+    def pack_stats(self, value):
+        self._render_state.pack_stats = value
+
+    @property
+    def content(self):
+        """content.xml xml object of the document being rendered. It is
+        parsed the first time it is requested, so renders not using it
+        never build it."""
+        if self._content is None and self._content_source is not None:
+            self._content = parseString(self._content_source)
+
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._automatic_styles = self._automatic_styles_node = None
+
+    @property
+    def automatic_styles(self):
+        """Map of style names to the nodes of content.xml's
+        <office:automatic-styles>, for the document being rendered. It is
+        built the first time it is requested and updated when new styles
+        are inserted."""
+        if self._automatic_styles is None and self.content is not None:
+            auto_styles = self.content.getElementsByTagName(
+                'office:automatic-styles')[0]
+
+            styles = {}
+            for style_node in auto_styles.childNodes:
+                if style_node.nodeType == style_node.ELEMENT_NODE and \
+                   style_node.hasAttribute('style:name'):
+                    styles.setdefault(style_node.getAttribute('style:name'),
+                                      style_node)
+
+            self._automatic_styles = styles
+            self._automatic_styles_node = auto_styles
+
+        return self._automatic_styles
+
+    @property
+    def manifest(self):
+        """META-INF/manifest.xml xml object of the document being rendered.
+        Like `content`, it is parsed the first time it is requested."""
+        if self._manifest is None and self._manifest_source is not None:
+            self._manifest = parseString(self._manifest_source)
+
+        return self._manifest
+
+    @manifest.setter
+    def manifest(self, value):
+        self._manifest = value
+
+
     def media_loader(self, callback):
         """This sets the the media loader. A user defined function which
         loads media. The function should take a template value, optionals
@@ -154,99 +1338,288 @@ class Renderer(object):
         element if a file object type representing the media and its second
         elements is the media mimetype.
 
+        The loader can be a coroutine function when templates are rendered
+        with render_async.
+
         See Renderer.fs_loader funcion for an example"""
         self.media_callback = callback
         return callback
 
+    @contextmanager
+    def _collect_stats(self, operation):
+        # Run `operation` in a render state of its own, yielded, collecting
+        # its stats and reporting them to stats_callback when it succeeds.
+        # Operations run by another one, i.e. compile by render, are
+        # reported as part of it.
+        with self._new_render_state() as state:
+            if self.stats_callback is None or state.stats is not None:
+                yield state
+                return
+
+            stats = state.stats = RenderStats(operation)
+            start = timer()
+            yield state
+
+        stats.total = timer() - start
+        self.stats_callback(stats)
+
+    def _timed(self, phase, function, *args, **kwargs):
+        # Call function, adding the time spent on it to `phase` when
+        # stats are being collected
+        stats = self._stats
+        if stats is None:
+            return function(*args, **kwargs)
+
+        start = timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.add_time(phase, timer() - start)
+
+    def _count(self, counter, value=1):
+        if self._stats is not None:
+            self._stats.count(counter, value)
+
+    @staticmethod
+    def _is_flat_template(template):
+        # Flat ODF documents are xml files instead of zip archives
+        if not hasattr(template, 'seek'):
+            return not zipfile.is_zipfile(template)
+
+        position = template.tell()
+        try:
+            return not zipfile.is_zipfile(template)
+        finally:
+            template.seek(position)
+
+    def _unpack_flat_template(self, template):
+        # A Flat ODF document is split into the members the rest of the
+        # renderer works with: content.xml with the automatic styles and
+        # body, and styles.xml with every other node, where the automatic
+        # styles and body are left empty. _pack_flat_document joins them
+        # again.
+        self.log.debug('Reading flat template file')
+        if hasattr(template, 'read'):
+            xml = template.read()
+        else:
+            with open(template, 'rb') as template_file:
+                xml = template_file.read()
+
+        xml = xml.decode('utf-8')
+        root = re.search(r'<office:document[\s>]', xml)
+        end = xml.rfind('</office:document>')
+        if root is None or end < 0:
+            raise SecretaryError('Template is not an ODF or Flat ODF document')
+
+        root_end = xml.index('>', root.start()) + 1
+        root_attributes = xml[root.end() - 1:root_end]
+        nodes = xml[root_end:end]
+
+        parts = self._split_node(nodes, 'office:automatic-styles')
+        if parts is None:
+            # Put them before the body, where they are written
+            parts = self._split_body(nodes)
+            parts = (parts[0], '<office:automatic-styles/>',
+                     parts[1] + parts[2])
+        before, automatic_styles, after = parts
+        middle, body, after = self._split_body(after)
+
+        declaration = '<?xml version="1.0" encoding="UTF-8"?>'
+        content = ''.join([
+            declaration, '<office:document-content', root_attributes,
+            automatic_styles, body, '</office:document-content>'])
+        styles = ''.join([
+            declaration, '<office:document-styles', root_attributes, before,
+            '<office:automatic-styles/>', middle, '<office:body/>', after,
+            '</office:document-styles>'])
+
+        files = OrderedDict()
+        files['content.xml'] = content.encode('utf-8')
+        files['styles.xml'] = styles.encode('utf-8')
+
+        return files
+
     def _unpack_template(self, template):
         # And Open/libreOffice is just a ZIP file. Here we unarchive the file
-        # and return a dict with every file in the archive
+        # and return a dict with every file in the archive. Files secretary
+        # never modifies are kept compressed, as RawZipMember objects, so
+        # they are copied to rendered documents without being decompressed
+        # and compressed again.
         self.log.debug('Unpacking template file')
 
-        archive_files = {}
+        archive_files = OrderedDict()
         archive = zipfile.ZipFile(template, 'r')
         for zfile in archive.filelist:
-            archive_files[zfile.filename] = archive.read(zfile.filename)
-
-        return archive_files
+            if zfile.filename in RENDERED_FILES or zfile.flag_bits & 0x01:
+                archive_files[zfile.filename] = archive.read(zfile.filename)
+            else:
+                archive_files[zfile.filename] = RawZipMember.read(archive, zfile)
 
         self.log.debug('Unpack completed')
 
-    def _pack_document(self, files):
-        # Store to a zip files in files
+        return archive_files
+
+    def _pack_document(self, files, fileobj=None):
+        # Store to a zip files in files. When `fileobj` is given, the archive
+        # is written straight into it, otherwise into a new BytesIO object.
+        # Size and time spent on every member is kept in pack_stats.
         self.log.debug('packing document')
-        zip_file = io.BytesIO()
+        zip_file = fileobj if fileobj is not None else io.BytesIO()
+        self.pack_stats = []
 
-        zipdoc = zipfile.ZipFile(zip_file, 'a')
+        start_position = 0
+        if self._stats is not None and hasattr(zip_file, 'tell'):
+            try:
+                start_position = zip_file.tell()
+            except (IOError, OSError):
+                pass
+
+        zipdoc = zipfile.ZipFile(zip_file, 'w')
         for fname, content in files.items():
-            if sys.version_info >= (2, 7):
-                zipdoc.writestr(fname, content, zipfile.ZIP_DEFLATED)
+            start = timer()
+            if isinstance(content, RawZipMember):
+                content.write(zipdoc)
             else:
-                zipdoc.writestr(fname, content)
-
+                self._write_member(zipdoc, fname, content)
+
+            info = zipdoc.filelist[-1]
+            self.pack_stats.append({
+                'name': fname,
+                'size': info.file_size,
+                'compress_size': info.compress_size,
+                'compress_type': info.compress_type,
+                'raw': isinstance(content, RawZipMember),
+                'time': timer() - start,
+            })
+
+        zipdoc.close()
         self.log.debug('Document packing completed')
 
-        return zip_file
-
-
-    @staticmethod
-    def _inc_node_tags_count(node, is_block=False):
-        """ Increase field count of node and its parents """
-
-        if node is None:
-            return
+        if self._stats is not None and hasattr(zip_file, 'tell'):
+            try:
+                self._count('output_bytes', zip_file.tell() - start_position)
+            except (IOError, OSError):
+                pass
 
-        for attr in ['field_count', 'block_count', 'var_count']:
-            if not hasattr(node, attr):
-                setattr(node, attr, 0)
+        return zip_file
 
-        node.field_count += 1
-        if is_block:
-            node.block_count += 1
+    def _pack_flat_document(self, files, fileobj=None):
+        # Write a Flat ODF document, a single xml file, into `fileobj` or a
+        # new BytesIO object. It is styles.xml of a template unpacked by
+        # _unpack_flat_template, with the automatic styles and body of
+        # content.xml in place of their empty nodes. Other members, i.e.
+        # the manifest, are not part of it.
+        self.log.debug('Writing flat document')
+        output = fileobj if fileobj is not None else io.BytesIO()
+        self.pack_stats = []
+
+        content = files['content.xml']
+        if isinstance(content, StreamedZipMember):
+            # Chunks are content head, body chunks and content tail
+            chunks = iter(content.chunks)
+            head = next(chunks)
         else:
-            node.var_count += 1
-
-        Renderer._inc_node_tags_count(node.parentNode, is_block)
+            head, body, _ = self._split_node(content, 'office:body')
+            chunks = None
+
+        automatic_styles = self._split_node(head, 'office:automatic-styles')
+        before, after = files['styles.xml'].split(b'<office:automatic-styles/>', 1)
+        middle, after = after.split(b'<office:body/>', 1)
+
+        written = [0]
+
+        def write(data):
+            output.write(data)
+            written[0] += len(data)
+
+        write(before.replace(b'<office:document-styles',
+                             b'<office:document', 1))
+        write(automatic_styles[1] if automatic_styles else
+              b'<office:automatic-styles/>')
+        write(middle)
+        if chunks is None:
+            write(body)
+        else:
+            previous = next(chunks)
+            for chunk in chunks:
+                write(previous)
+                previous = chunk
+            # The last chunk is the content tail
+        write(after.replace(b'</office:document-styles>',
+                            b'</office:document>'))
+
+        self._count('output_bytes', written[0])
+        self.log.debug('Flat document writing completed')
+
+        return output
+
+    def _write_member(self, zipdoc, fname, content):
+        # Write a new member into zipdoc, compressed as told by the
+        # compression policy
+        compress_type, level = self.compression.compression_for(fname)
+
+        info = zipfile.ZipInfo(fname, date_time=time.localtime()[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o600 << 16
+
+        if isinstance(content, StreamedZipMember):
+            # ZipFile.open takes no compression level, it reads it from
+            # the ZipInfo: compress_level from Python 3.13, _compresslevel
+            # before
+            if level is not None and ZIP_COMPRESSLEVEL:
+                if hasattr(zipfile.ZipInfo, 'compress_level'):
+                    info.compress_level = level
+                else:
+                    info._compresslevel = level
+
+            # The size is not known up front, zipfile raises when a member
+            # outgrows its header
+            with zipdoc.open(info, 'w', force_zip64=content.zip64) as member:
+                for chunk in content.chunks:
+                    member.write(chunk)
+        elif level is None or not ZIP_COMPRESSLEVEL:
+            zipdoc.writestr(info, content)
+        else:
+            zipdoc.writestr(info, content, compresslevel=level)
 
 
     def _compile_tags_expressions(self):
         self.tag_pattern = re.compile(r'(?is)^({0}|{1}).*({2}|{3})$'.format(
-            self.environment.variable_start_string,
-            self.environment.block_start_string,
-            self.environment.variable_end_string,
-            self.environment.block_end_string
+            re.escape(self.environment.variable_start_string),
+            re.escape(self.environment.block_start_string),
+            re.escape(self.environment.variable_end_string),
+            re.escape(self.environment.block_end_string)
         ))
 
         self.block_pattern = re.compile(r'(?is)^{0}.*{1}$'.format(
-            self.environment.block_start_string,
-            self.environment.block_end_string
+            re.escape(self.environment.block_start_string),
+            re.escape(self.environment.block_end_string)
         ))
 
         self._compile_escape_expressions()
 
 
     def _compile_escape_expressions(self):
-        # Compiles escape expressions
-        self.escape_map = dict()
-        unescape_rules = {
-            r'&gt;': r'>',
-            r'&lt;': r'<',
-            r'&amp;': r'&',
-            r'&quot;': r'"',
-            r'&apos;': r'\'',
+        # Compiles the expressions used to find jinja tags and escaped
+        # entities within them
+        environment = self.environment
+        self.tag_ends = {
+            environment.variable_start_string: environment.variable_end_string,
+            environment.block_start_string: environment.block_end_string,
         }
-
-        for key, value in unescape_rules.items():
-            exp = r'(?is)(({0}|{1})[^{3}{4}]*?)({2})([^{0}{1}]*?({3}|{4}))'
-            key = re.compile(exp.format(
-                self.environment.variable_start_string,
-                self.environment.block_start_string,
-                key,
-                self.environment.variable_end_string,
-                self.environment.block_end_string
-            ))
-
-            self.escape_map[key] = r'\1{0}\4'.format(value)
+        self.tag_start_pattern = re.compile('|'.join(
+            re.escape(start) for start in sorted(self.tag_ends, key=len,
+                                                 reverse=True)))
+
+        self.unescape_rules = {
+            'gt': '>',
+            'lt': '<',
+            'amp': '&',
+            'quot': '"',
+            'apos': '\'',
+        }
+        self.entity_pattern = re.compile(r'&(gt|lt|amp|quot|apos);')
+        self.link_pattern = re.compile(r'(?is)(xlink:href=\")secretary:(.*?)(\")')
 
     def _is_jinja_tag(self, tag):
         """
@@ -263,35 +1636,41 @@ class Renderer(object):
         return len(self.block_pattern.findall(tag)) > 0
 
 
-    def _tags_in_document(self, document):
+    def _field_index(self, document):
         """
-            Yields a list of available jinja instructions tags in document.
+        Index every jinja field in document, in a single pass. Returns a
+        list of (field, content, is_block, scale_to, ancestors) tuples, and a
+        dict with the field count of every node containing fields.
+
+        Counting fields within their parents is necesary to automaticaly
+        avoid generating invalid documents when mixing block tags in
+        differents parts of a document.
         """
-        tags = document.getElementsByTagName('text:text-input')
+        fields = []
+        counts = dict()
 
-        for tag in tags:
-            if not tag.hasChildNodes():
+        for field in document.iter('text:text-input'):
+            content = document.text(field)
+            if not content:
                 continue
 
-            content = tag.childNodes[0].data.strip()
+            content = content.strip()
             if not self._is_jinja_tag(content):
                 continue
 
-            yield tag
+            scale_to = document.get(field, 'text:description').strip().lower()
+            if content.lower().find('|markdown') > 0:
+                # Take whole paragraph when handling a markdown field
+                scale_to = 'text:p'
 
+            ancestors = document.ancestors(field)
+            for ancestor in ancestors:
+                counts[ancestor] = counts.get(ancestor, 0) + 1
 
-    def _census_tags(self, document):
-        """
-        Make a census of all available jinja tags in document. We count all
-        the children tags nodes within their parents. This process is necesary
-        to automaticaly avoid generating invalid documents when mixing block
-        tags in differents parts of a document.
-        """
-        for tag in self._tags_in_document(document):
-            content = tag.childNodes[0].data.strip()
-            block_tag = self._is_block_tag(content)
+            fields.append((field, content, self._is_block_tag(content),
+                           scale_to, ancestors))
 
-            self._inc_node_tags_count(tag.parentNode, block_tag)
+        return fields, counts
 
 
     def  _prepare_document_tags(self, document):
@@ -343,122 +1722,134 @@ class Renderer(object):
         # common parent for this tag and any other tag.
         # -------------------------------------------------------------------- #
         self.log.debug('Preparing document tags')
-        self._census_tags(document)
+        fields, counts = self._field_index(document)
+        self._count('fields', len(fields))
 
-        for tag in self._tags_in_document(document):
-            placeholder = tag
-            content = tag.childNodes[0].data.strip()
-            is_block = self._is_block_tag(content)
-            scale_to = tag.getAttribute('text:description').strip().lower()
-
-            if content.lower().find('|markdown') > 0:
-                # Take whole paragraph when handling a markdown field
-                scale_to = 'text:p'
+        for field, content, is_block, scale_to, ancestors in fields:
+            placeholder = field
 
             if scale_to:
                 if FLOW_REFERENCES.get(scale_to, False):
-                    placeholder = self._parent_of_type(
-                        tag, FLOW_REFERENCES[scale_to]
+                    placeholder = self._ancestor_of_type(
+                        document, ancestors, FLOW_REFERENCES[scale_to]
                     )
 
-                new_node = self.create_text_node(document, content)
+                document.insert_text(placeholder, content,
+                                     after=scale_to.startswith('after::'))
 
             elif is_block:
                 # expand up the placeholder until a shared parent is found
-                while not placeholder.parentNode.field_count > 1:
-                    placeholder = placeholder.parentNode
+                for ancestor in ancestors:
+                    if counts[ancestor] > 1:
+                        break
+                    placeholder = ancestor
 
-                if placeholder:
-                    new_node = self.create_text_node(document, content)
+                document.insert_text(placeholder, content)
 
             else:
-                new_node = self.create_text_span_node(document, content)
-
-            placeholder_parent = placeholder.parentNode
-            if not scale_to.startswith('after::'):
-                placeholder_parent.insertBefore(new_node, placeholder)
-            else:
-                if placeholder.isSameNode(placeholder_parent.lastChild):
-                    placeholder_parent.appendChild(new_node)
-                else:
-                    placeholder_parent.insertBefore(
-                        new_node, placeholder.nextSibling
-                    )
+                document.insert_span(placeholder, content)
 
             if scale_to.startswith(('after::', 'before::')):
                 # Don't remove whole field tag, only "text:text-input" container
-                placeholder = self._parent_of_type(tag, 'text:p')
-                placeholder_parent = placeholder.parentNode
-
+                placeholder = self._ancestor_of_type(document, ancestors,
+                                                     'text:p')
 
             # Finally, remove the placeholder
-            placeholder_parent.removeChild(placeholder)
+            document.remove(placeholder)
 
 
     def _unescape_entities(self, xml_text):
         """
         Unescape links and '&amp;', '&lt;', '&quot;' and '&gt;' within jinja
-        instructions. The regexs rules used here are compiled in
-        _compile_escape_expressions.
+        instructions. Jinja tags are found using the start and end strings
+        of the environment, and the text is scanned only once.
         """
-        for regexp, replacement in self.escape_map.items():
-            while True:
-                xml_text, substitutions = regexp.subn(replacement, xml_text)
-                if not substitutions:
-                    break
+        unescape = lambda match: self.unescape_rules[match.group(1)]
+        result = []
+        position = 0
 
-        return self._unescape_links(xml_text)
+        while True:
+            start = self.tag_start_pattern.search(xml_text, position)
+            if start is None:
+                break
+
+            end_string = self.tag_ends[start.group()]
+            end = xml_text.find(end_string, start.end())
+            if end < 0:
+                break
+
+            result.append(xml_text[position:start.end()])
+            result.append(self.entity_pattern.sub(unescape,
+                                                  xml_text[start.end():end]))
+            position = end
+
+        result.append(xml_text[position:])
+
+        return self._unescape_links(''.join(result))
 
     def _unescape_links(self, xml_text):
         """Fix Libreoffice auto escaping of xlink:href attribute values.
         This unescaping is only done on 'secretary' scheme URLs."""
-        import urllib
-        robj = re.compile(r'(?is)(xlink:href=\")secretary:(.*?)(\")')
 
         def replacement(match):
-            return ''.join([match.group(1), urllib.unquote(match.group(2)),
+            return ''.join([match.group(1), unquote(match.group(2)),
                             match.group(3)])
 
-        while True:
-            xml_text, rep = robj.subn(replacement, xml_text)
-            if not rep:
-                break
-
-        return xml_text
+        return self.link_pattern.sub(replacement, xml_text)
 
     @staticmethod
     def _encode_escape_chars(xml_text):
         """
         Replace line feed and/or tabs within text:span entities.
         """
-        find_pattern = r'(?is)<text:([\S]+?)>([^>]*?([\n|\t])[^<]*?)</text:\1>'
-        for m in re.findall(find_pattern, xml_text):
-            replacement = m[1].replace('\n', '<text:line-break/>')
-            replacement = replacement.replace('\t', '<text:tab/>')
-            xml_text = xml_text.replace(m[1], replacement)
+        def replacement(match):
+            text = match.group(2)
+            if '\n' not in text and '\t' not in text:
+                return match.group(0)
 
-        return xml_text
+            text = text.replace('\n', '<text:line-break/>')
+            text = text.replace('\t', '<text:tab/>')
+            return '<text:{0}>{1}</text:{0}>'.format(match.group(1), text)
+
+        return ESCAPE_CHARS_PATTERN.sub(replacement, xml_text)
 
 
     def add_media_to_archive(self, media, mime, name=''):
         """
         Adds to "Pictures" archive folder the file in `media` and register
-        it into manifest file.
+        it into manifest file. When no `name` is given the file is named
+        after the hash of its content, so the same media is stored only
+        once in the document. Media added with the `name` of a file already
+        in the document replaces it.
         """
+        media.seek(0)
+        content = media.read(-1)
+        if hasattr(media, 'close'):
+            media.close()
+
         extension = None
         if hasattr(media, 'name') and not name:
-            extension = path.splitext(media.name)
-            name      = extension[0]
-            extension = extension[1]
+            extension = path.splitext(media.name)[1]
 
         if not extension:
             extension = guess_extension(mime)
 
+        if not name:
+            name = sha1(content).hexdigest()
+
         media_path = 'Pictures/%s%s' % (name, extension)
-        media.seek(0)
-        self.files[media_path] = media.read(-1)
-        if hasattr(media, 'close'):
-            media.close()
+        if self.files.get(media_path) == content:
+            return media_path
+
+        replaced = media_path in self.files
+        self.files[media_path] = content
+
+        if replaced:
+            entries = self.manifest.getElementsByTagName('manifest:file-entry')
+            for node in entries:
+                if node.getAttribute('manifest:full-path') == media_path:
+                    node.setAttribute('manifest:media-type', mime)
+                    return media_path
 
         files_node = self.manifest.getElementsByTagName('manifest:manifest')[0]
         node = self.create_node(self.manifest, 'manifest:file-entry', files_node)
@@ -491,98 +1882,484 @@ class Renderer(object):
         return (open(filename, 'rb'), mime[0] if mime else None)
 
 
-    def replace_images(self, xml_document):
-        """Perform images replacements"""
-        self.log.debug('Inserting images')
-        frames = xml_document.getElementsByTagName('draw:frame')
+    def _image_placeholders(self, xml_document):
+        """Yields a (frame, image_node, key) tuple for every placeholder
+        image in `xml_document`. `key` is the template_images key of the
+        image to insert in the frame."""
+        frames = xml_document.iter('draw:frame')
 
         for frame in frames:
-            if not frame.hasChildNodes():
+            image_node = xml_document.first_child(frame)
+            if image_node is None:
                 continue
 
-            key = frame.getAttribute('draw:name')
+            key = xml_document.get(frame, 'draw:name')
             if key not in self.template_images:
                 continue
 
-            # Get frame attributes
-            frame_attrs = dict()
-            for i in xrange(frame.attributes.length):
-                attr = frame.attributes.item(i)
-                frame_attrs[attr.name] = attr.value
-
-            # Get child draw:image node and its attrs
-            image_node = frame.childNodes[0]
-            image_attrs = dict()
-            for i in xrange(image_node.attributes.length):
-                attr = image_node.attributes.item(i)
-                image_attrs[attr.name] = attr.value
-
-            # Request to media loader the image to use
-            image = self.media_callback(self.template_images[key]['value'],
-                                        *self.template_images[key]['args'],
-                                        frame_attrs=frame_attrs,
-                                        image_attrs=image_attrs,
-                                        **self.template_images[key]['kwargs'])
-
-            # Update frame and image node attrs (if they where updated in
-            # media_callback call)
-            for k, v in frame_attrs.items():
-                frame.setAttribute(k, v)
-
-            for k, v in image_attrs.items():
-                image_node.setAttribute(k, v)
-
-            # Keep original image reference value
-            if isinstance(self.template_images[key]['value'], basestring):
-                frame.setAttribute('draw:name',
-                                   self.template_images[key]['value'])
-
-            # Does the madia loader returned something?
-            if not image:
-                continue
+            yield frame, image_node, key
 
-            mname = self.add_media_to_archive(media=image[0], mime=image[1],
-                                              name=key)
-            if mname:
-                image_node.setAttribute('xlink:href', mname)
+    def _update_image(self, xml_document, frame, image_node, key, frame_attrs,
+                      image_attrs, image):
+        """Insert `image`, as returned by the media loader, into `frame`"""
 
-    def _render_xml(self, xml_document, **kwargs):
-        # Prepare the xml object to be processed by jinja2
-        self.log.debug('Rendering XML object')
-        template_string = ""
+        # Update frame and image node attrs (if they where updated in
+        # media_callback call)
+        for k, v in frame_attrs.items():
+            xml_document.set(frame, k, v)
+
+        for k, v in image_attrs.items():
+            xml_document.set(image_node, k, v)
+
+        # Keep original image reference value
+        if isinstance(self.template_images[key]['value'], basestring):
+            xml_document.set(frame, 'draw:name',
+                             self.template_images[key]['value'])
 
+        # Does the madia loader returned something?
+        if not image:
+            return
+
+        if self._render_state.flat:
+            self._inline_media(xml_document, image_node, image[0])
+            return
+
+        mname = self.add_media_to_archive(media=image[0], mime=image[1])
+        if mname:
+            xml_document.set(image_node, 'xlink:href', mname)
+
+    def _inline_media(self, xml_document, image_node, media):
+        """Write `media` into `image_node` as base64 office:binary-data,
+        the way Flat ODF documents keep their media."""
+        media.seek(0)
+        content = media.read(-1)
+        if hasattr(media, 'close'):
+            media.close()
+
+        xml_document.remove_attribute(image_node, 'xlink:href')
+        xml_document.replace_children(image_node, 'office:binary-data',
+                                      base64.b64encode(content).decode('ascii'))
+
+    def _media_cache_key(self, key, frame_attrs, image_attrs):
+        # Returns the media cache key of template_images[key], or None if it
+        # can not be cached
+        if not self.media_cache.max_size:
+            return None
+
+        image = self.template_images[key]
+        if not isinstance(image['value'], (basestring, int, float)):
+            return None
+
+        # Frame name is the template_images key, unique for every image
+        frame_attrs = [(k, v) for k, v in frame_attrs.items()
+                       if k != 'draw:name']
+
+        cache_key = (image['value'], tuple(image['args']),
+                     tuple(sorted(image['kwargs'].items())),
+                     tuple(sorted(frame_attrs)),
+                     tuple(sorted(image_attrs.items())))
         try:
-            self.template_images = dict()
-            self._prepare_document_tags(xml_document)
-            xml_source = xml_document.toxml()
-            xml_source = xml_source.encode('ascii', 'xmlcharrefreplace')
-            jinja_template = self.environment.from_string(
-                self._unescape_entities(xml_source.decode('utf-8'))
-            )
+            hash(cache_key)
+        except TypeError:
+            return None
 
-            result = jinja_template.render(**kwargs)
-            result = self._encode_escape_chars(result)
+        return cache_key
 
-            final_xml = parseString(result.encode('ascii', 'xmlcharrefreplace'))
-            if self.template_images:
-                self.replace_images(final_xml)
+    def _cached_media(self, cache_key, frame_attrs, image_attrs):
+        """Returns the image cached under `cache_key`, like the media loader
+        would return it, or None. Frame and image attributes updated by the
+        loader are updated again."""
+        if cache_key is None:
+            return None
 
-            return final_xml
-        except ExpatError as e:
-            if not 'result' in locals():
-                result = xml_source
-            near = result.split('\n')[e.lineno -1][e.offset-200:e.offset+200]
-            raise ExpatError('ExpatError "%s" at line %d, column %d\nNear of: "[...]%s[...]"' % \
-                             (ErrorString(e.code), e.lineno, e.offset, near))
-        except:
-            self.log.error('Error rendering template:\n%s',
-                           xml_document.toprettyxml(), exc_info=True)
+        cached = self.media_cache.get(cache_key)
+        if cached is None:
+            return None
+
+        content, mime, name, cached_frame_attrs, cached_image_attrs = cached
+        frame_attrs.update(cached_frame_attrs)
+        image_attrs.update(cached_image_attrs)
+
+        media = io.BytesIO(content)
+        if isinstance(name, basestring):
+            media.name = name
+
+        return (media, mime)
+
+    def _cache_media(self, cache_key, image, frame_attrs, image_attrs):
+        """Store in media cache the image returned by the media loader.
+        Returns the image to use instead of the one returned by the loader,
+        since its file object was consumed."""
+        if cache_key is None or not image:
+            return image
+
+        media, mime = image[0], image[1]
+        media.seek(0)
+        content = media.read(-1)
+        name = getattr(media, 'name', None)
+        if hasattr(media, 'close'):
+            media.close()
+
+        frame_attrs = dict((k, v) for k, v in frame_attrs.items()
+                           if k != 'draw:name')
+        self.media_cache.set(
+            cache_key,
+            (content, mime, name, frame_attrs, dict(image_attrs)),
+            len(content)
+        )
+
+        media = io.BytesIO(content)
+        if isinstance(name, basestring):
+            media.name = name
+
+        return (media, mime)
+
+    def _load_media(self, key, frame_attrs, image_attrs):
+        """Request to media loader the image of template_images[key]. Images
+        are taken from media cache when possible."""
+        cache_key = self._media_cache_key(key, frame_attrs, image_attrs)
+        image = self._cached_media(cache_key, frame_attrs, image_attrs)
+        if image is not None:
+            self._count('media_cache_hits')
+            return image
+
+        image = self._timed('media_loader', self.media_callback,
+                            self.template_images[key]['value'],
+                            *self.template_images[key]['args'],
+                            frame_attrs=frame_attrs,
+                            image_attrs=image_attrs,
+                            **self.template_images[key]['kwargs'])
+
+        if hasattr(image, '__await__'):
+            if hasattr(image, 'close'):
+                image.close()
+            raise SecretaryError('Media loader returned an awaitable. '
+                                 'Use render_async with async media loaders.')
+
+        return self._cache_media(cache_key, image, frame_attrs, image_attrs)
+
+    def replace_images(self, xml_document):
+        """Perform images replacements"""
+        self.log.debug('Inserting images')
+
+        for frame, image_node, key in self._image_placeholders(xml_document):
+            frame_attrs = xml_document.attributes(frame)
+            image_attrs = xml_document.attributes(image_node)
+
+            image = self._load_media(key, frame_attrs, image_attrs)
+            self._update_image(xml_document, frame, image_node, key,
+                               frame_attrs, image_attrs, image)
+            self._count('images')
+
+    def _prepare_xml(self, xml_document):
+        """Prepare the tags of `xml_document` and return its text ready to
+        be compiled as a jinja template."""
+        self.log.debug('Preparing XML object')
+        self._prepare_document_tags(xml_document)
+
+        return self._unescape_entities(xml_document.serialize())
 
+    def _compile_xml(self, template_string, name=None, environment=None):
+        """Compile a text returned by _prepare_xml into a jinja template of
+        `environment`, the renderer environment by default. When `name` is
+        given and there is a cache_dir, the compiled code is kept in the
+        bytecode cache under that name."""
+        self.log.debug('Compiling XML object')
+        environment = environment or self.environment
+
+        try:
+            if name is None or self.bytecode_cache is None:
+                return self._timed('compile', environment.from_string,
+                                   template_string)
+
+            return self._timed('compile', self._compile_cached, environment,
+                               name, template_string)
+        except:
+            self.log.error('Error compiling template', exc_info=True)
             self.log.error('Unescaped template was:\n{0}'.format(template_string))
             raise
+        finally:
+            self.log.debug('Compiling xml object finished')
+
+    def _compile_cached(self, environment, name, source):
+        # Like environment.from_string, but the compiled code is loaded
+        # from, or stored in, the bytecode cache. The bucket is only used
+        # when its source checksum and jinja version match.
+        bucket = self.bytecode_cache.get_bucket(environment, name, None, source)
+
+        code = bucket.code
+        if code is None:
+            code = environment.compile(source, name)
+            bucket.code = code
+            self.bytecode_cache.set_bucket(bucket)
+
+        return environment.template_class.from_code(
+            environment, code, environment.make_globals(None), None)
+
+    def _template_cache_key(self, files):
+        """Key of a template in cache_dir. It changes with the template xml
+        files, secretary version and the jinja delimiters used to prepare
+        them."""
+        environment = self.environment
+        key = sha1()
+        for value in (__version__,
+                      environment.block_start_string,
+                      environment.block_end_string,
+                      environment.variable_start_string,
+                      environment.variable_end_string,
+                      environment.comment_start_string,
+                      environment.comment_end_string):
+            key.update(('%s\0' % value).encode('utf-8'))
+
+        key.update(files['content.xml'])
+        key.update(b'\0')
+        key.update(files['styles.xml'])
+
+        return key.hexdigest()
+
+    def _read_prepared(self, cache_key):
+        # Returns the prepared sources of a template from cache_dir, or
+        # None if they are not there
+        filename = path.join(self.cache_dir, 'secretary-%s.json' % cache_key)
+        try:
+            with io.open(filename, 'r', encoding='utf-8') as cached:
+                return json.load(cached)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_prepared(self, cache_key, sources):
+        # Store the prepared sources of a template in cache_dir. The file is
+        # renamed into place so readers never find it half written.
+        filename = path.join(self.cache_dir, 'secretary-%s.json' % cache_key)
+        try:
+            fd, temp_name = tempfile.mkstemp(dir=self.cache_dir)
+            with io.open(fd, 'w', encoding='utf-8') as cached:
+                cached.write(json.dumps(sources, ensure_ascii=False))
+            getattr(os, 'replace', os.rename)(temp_name, filename)
+        except (IOError, OSError):
+            self.log.warning('Could not write template cache %s', filename,
+                             exc_info=True)
+
+    def _render_template(self, jinja_template, **kwargs):
+        # Render a template compiled by _compile_xml and return the
+        # resulting xml text
+        self.log.debug('Rendering XML object')
+
+        try:
+            self.template_images = dict()
+            result = self._timed('render', jinja_template.render, **kwargs)
+
+            return self._timed('encode_escape_chars',
+                               self._encode_escape_chars, result)
+        except:
+            self.log.error('Error rendering template', exc_info=True)
+            raise
         finally:
             self.log.debug('Rendering xml object finished')
 
+    def _generate_template(self, jinja_template, chunk_size=STREAM_CHUNK_SIZE,
+                           **kwargs):
+        # Like _render_template, but the xml text is yielded in chunks of
+        # about chunk_size characters as jinja renders it. Line feeds and
+        # tabs are encoded chunk by chunk: the text after the last text: tag
+        # of a chunk is kept for the next one, it may be cut in the middle
+        # of a text node.
+        self.log.debug('Generating XML object')
+        self.template_images = dict()
+
+        stats = self._stats
+        parts = jinja_template.generate(**kwargs)
+        remainder = ''
+        done = False
+        while not done:
+            start = timer()
+            chunk, size = [remainder], 0
+            for part in parts:
+                chunk.append(part)
+                size += len(part)
+                if size >= chunk_size:
+                    break
+            else:
+                done = True
+
+            if stats is not None:
+                stats.add_time('render', timer() - start)
+
+            text = ''.join(chunk)
+            cut = len(text)
+            if not done:
+                cut = text.rfind('<text:')
+                if cut < 0:
+                    cut = text.rfind('<')
+                if cut < 0:
+                    cut = len(text)
+
+            remainder = text[cut:]
+            text = self._timed('encode_escape_chars',
+                               self._encode_escape_chars, text[:cut])
+
+            if text:
+                yield text
+
+        self.log.debug('Generating xml object finished')
+
+    def _finalize_xml(self, xml_text):
+        """
+        Perform images replacement on a rendered xml text. Only when there
+        are images to replace the text is parsed into an xml object, otherwise
+        it is returned as is, after an optional well formed check.
+        """
+        if self.template_images:
+            final_xml = self._timed('parse_rendered', self._parse_xml, xml_text)
+            self._timed('replace_images', self.replace_images, final_xml)
+            return self._timed('serialize', final_xml.serialize)
+
+        if self.check_xml:
+            self._timed('check_xml', self._check_xml, xml_text)
+
+        return xml_text
+
+    def _parse_xml(self, xml_text):
+        """Parse a rendered xml text into a xml object."""
+        try:
+            return self.xml_document(xml_text.encode('utf-8'))
+        except ExpatError as e:
+            raise self._expat_error(e, xml_text)
+
+    def _check_xml(self, xml_text):
+        """Raises ExpatError if `xml_text` is not a well formed document."""
+        try:
+            parser = ParserCreate()
+            parser.Parse(xml_text.encode('utf-8'), True)
+        except ExpatError as e:
+            raise self._expat_error(e, xml_text)
+
+    def _encode_xml(self, xml_text):
+        """Encode a rendered xml text as UTF-8, or as ASCII with character
+        references when ascii_output is set."""
+        if self.ascii_output:
+            return xml_text.encode('ascii', 'xmlcharrefreplace')
+
+        return xml_text.encode('utf-8')
+
+    @staticmethod
+    def _expat_error(e, xml_text):
+        # Returns a new ExpatError including the text near of the error
+        message = ErrorString(e.code) if getattr(e, 'code', None) else e.args[0]
+        near = xml_text.split('\n')[e.lineno -1][max(e.offset-200, 0):e.offset+200]
+        return ExpatError('ExpatError "%s" at line %d, column %d\nNear of: "[...]%s[...]"' % \
+                          (message, e.lineno, e.offset, near))
+
+    @staticmethod
+    def _split_node(xml_text, tag):
+        """
+        Split xml text, or bytes, into the text before the first `tag`
+        node, the node itself and the text after it. Returns None if there
+        is no `tag` node. Nodes of the same type can not be nested in it.
+        """
+        start_tag, end_tag = '<' + tag, '</%s>' % tag
+        if isinstance(xml_text, bytes):
+            start_tag = start_tag.encode('ascii')
+            end_tag = end_tag.encode('ascii')
+            pattern = re.escape(start_tag) + br'[\s>/]'
+            close = b'>'
+        else:
+            pattern = re.escape(start_tag) + r'[\s>/]'
+            close = '>'
+
+        start = re.search(pattern, xml_text)
+        if start is None:
+            return None
+
+        end = xml_text.find(end_tag, start.start())
+        if end < 0:
+            # An empty node is written as <tag/>
+            end = xml_text.index(close, start.start()) + 1
+        else:
+            end += len(end_tag)
+
+        return (xml_text[:start.start()], xml_text[start.start():end],
+                xml_text[end:])
+
+    @staticmethod
+    def _split_body(xml_text):
+        """
+        Split content.xml text into the text before <office:body>, the
+        <office:body> node itself and the text after it.
+        """
+        parts = Renderer._split_node(xml_text, 'office:body')
+        if parts is None:
+            raise SecretaryError('content.xml does not have a office:body node')
+
+        return parts
+
+
+    def compile(self, template):
+        """
+            Prepare a template once so it can be rendered many times.
+
+            Unpacking the archive, preparing the document tags and compiling
+            the jinja templates is done here, so rendering the returned
+            object only has to run jinja and pack the resulting document.
+
+            args:
+                template: A template file. Could be a string or a file instance.
+                          Flat ODF (.fodt) templates are rendered into Flat
+                          ODF documents.
+
+            returns:
+                A CompiledTemplate instance.
+        """
+
+        return self._compile(template)
+
+    def _compile(self, template, async_only=False):
+        # Renderer.compile. With `async_only` jinja templates are only
+        # compiled for render_async.
+        self.log.debug('Compiling template')
+        with self._collect_stats('compile'):
+            flat = self._is_flat_template(template)
+            if flat:
+                files = self._timed('unpack', self._unpack_flat_template,
+                                    template)
+            else:
+                files = self._timed('unpack', self._unpack_template, template)
+
+            cache_key = sources = None
+            if self.cache_dir is not None:
+                cache_key = self._template_cache_key(files)
+                sources = self._read_prepared(cache_key)
+                self._count('template_cache_hits', sources is not None)
+
+            if sources is None:
+                content = self._timed('parse', self.template_document,
+                                      files['content.xml'])
+                styles = self._timed('parse', self.template_document,
+                                     files['styles.xml'])
+
+                # Only the office:body node of content.xml is rendered by
+                # jinja. The rendered body is later spliced as text between
+                # the content head and tail.
+                head, body, tail = self._split_body(
+                    self._timed('prepare', self._prepare_xml, content))
+                sources = dict(
+                    content_head=head,
+                    content_tail=tail,
+                    content_source=body,
+                    styles_source=self._timed('prepare', self._prepare_xml,
+                                              styles)
+                )
+
+                if cache_key is not None:
+                    self._write_prepared(cache_key, sources)
+
+            compiled = CompiledTemplate(self, files, cache_key=cache_key,
+                                        flat=flat, async_only=async_only,
+                                        **sources)
+
+        self.log.debug('Template compiling finished')
+        return compiled
+
 
     def render(self, template, **kwargs):
         """
@@ -596,47 +2373,92 @@ class Renderer(object):
                 A binary stream which contains the rendered document.
         """
 
-        self.log.debug('Initing a template rendering')
-        self.files = self._unpack_template(template)
-        self.render_vars = {}
+        with self._collect_stats('render'):
+            return self.compile(template).render(**kwargs)
 
-        # Keep content and styles object since many functions or
-        # filters may work with then
-        self.content  = parseString(self.files['content.xml'])
-        self.styles   = parseString(self.files['styles.xml'])
-        self.manifest = parseString(self.files['META-INF/manifest.xml'])
-
-        # Render content.xml keeping just 'office:body' node.
-        rendered_content = self._render_xml(self.content, **kwargs)
-        self.content.getElementsByTagName('office:document-content')[0].replaceChild(
-            rendered_content.getElementsByTagName('office:body')[0],
-            self.content.getElementsByTagName('office:body')[0]
-        )
 
-        # Render styles.xml
-        self.styles = self._render_xml(self.styles, **kwargs)
+    def render_many(self, template, contexts, workers=None,
+                    return_exceptions=False):
+        """
+            Render a template once for every context in `contexts` using a
+            pool of worker processes. See CompiledTemplate.render_many.
 
-        self.log.debug('Template rendering finished')
+            args:
+                template: A template file. Could be a string or a file instance
+                contexts: An iterable of dicts with template variables.
+                workers: Number of worker processes. Defaults to the number
+                         of CPUs.
+                return_exceptions: Yield the exception of failed renders
+                                   instead of raising it.
 
-        self.files['content.xml']           = self.content.toxml().encode('ascii', 'xmlcharrefreplace')
-        self.files['styles.xml']            = self.styles.toxml().encode('ascii', 'xmlcharrefreplace')
-        self.files['META-INF/manifest.xml'] = self.manifest.toxml().encode('ascii', 'xmlcharrefreplace')
+            returns:
+                An iterator of (index, document) tuples, in completion order.
+        """
 
-        document = self._pack_document(self.files)
-        return document.getvalue()
+        return self.compile(template).render_many(contexts, workers,
+                                                  return_exceptions)
 
 
-    def _parent_of_type(self, node, of_type):
-        # Returns the first immediate parent of type `of_type`.
+    def render_async(self, template, **kwargs):
+        """
+            Render a template using jinja's async mode. This method returns
+            a coroutine, see CompiledTemplate.render_async.
+
+            args:
+                template: A template file. Could be a string or a file instance
+                **kwargs: Template variables. Values can be awaitables.
+
+            returns:
+                A coroutine returning the rendered document.
+        """
+        from secretary_async import render_template
+
+        return render_template(self, template, **kwargs)
+
+
+    def render_to(self, template, fileobj, **kwargs):
+        """
+            Render a template writing the document straight into `fileobj`
+
+            args:
+                template: A template file. Could be a string or a file instance
+                fileobj: A writable file object. On Python 3.5 or later it
+                         does not need to be seekable, so a socket file or
+                         a pipe can be used.
+                **kwargs: Template variables. Similar to jinja2
+        """
+
+        with self._collect_stats('render'):
+            self.compile(template).render_to(fileobj, **kwargs)
+
+
+    def stream_to(self, template, fileobj, zip64=False, **kwargs):
+        """
+            Render a template writing the document into `fileobj` while
+            content.xml is rendered. See CompiledTemplate.stream_to.
+
+            args:
+                template: A template file. Could be a string or a file instance
+                fileobj: A writable file object. It does not need to be
+                         seekable.
+                zip64: Write content.xml with ZIP64 sizes, needed when it
+                       is larger than 2 GiB.
+                **kwargs: Template variables. Similar to jinja2
+        """
+
+        with self._collect_stats('render'):
+            self.compile(template).stream_to(fileobj, zip64, **kwargs)
+
+
+    @staticmethod
+    def _ancestor_of_type(document, ancestors, of_type):
+        # Returns the first node of type `of_type` in `ancestors`.
         # Returns None if nothing is found.
+        for ancestor in ancestors:
+            if document.tag(ancestor).lower() == of_type:
+                return ancestor
 
-        if hasattr(node, 'parentNode'):
-            if node.parentNode.nodeName.lower() == of_type:
-                return node.parentNode
-            else:
-                return self._parent_of_type(node.parentNode, of_type)
-        else:
-            return None
+        return None
 
     def create_node(self, xml_document, node_type, parent=None):
         """Creates a node in `xml_document` of type `node_type` and specified,
@@ -668,18 +2490,7 @@ class Renderer(object):
             return the style node
         """
 
-        auto_styles = self.content.getElementsByTagName(
-            'office:automatic-styles')[0]
-
-        if not auto_styles.hasChildNodes():
-            return None
-
-        for style_node in auto_styles.childNodes:
-            if style_node.hasAttribute('style:name') and \
-               (style_node.getAttribute('style:name') == style_name):
-               return style_node
-
-        return None
+        return self.automatic_styles.get(style_name)
 
     def insert_style_in_content(self, style_name, attributes=None,
         **style_properties):
@@ -688,7 +2499,12 @@ class Renderer(object):
             Returns a reference to the newly created node
         """
 
-        auto_styles = self.content.getElementsByTagName('office:automatic-styles')[0]
+        if self._render_state.streaming:
+            raise SecretaryError(
+                'Style %s can not be inserted, content.xml head is already '
+                'written when it is streamed' % style_name)
+
+        styles = self.automatic_styles
         style_node = self.content.createElement('style:style')
 
         style_node.setAttribute('style:name', style_name)
@@ -706,7 +2522,26 @@ class Renderer(object):
 
             style_node.appendChild(style_prop)
 
-        return auto_styles.appendChild(style_node)
+        styles.setdefault(style_name, style_node)
+        return self._automatic_styles_node.appendChild(style_node)
+
+    def register_style(self, style_name, attributes=None, **style_properties):
+        """
+            Return the style_name node of content.xml's
+            <office:automatic-styles>, inserting the style if it does not
+            exist yet. Lookups are done in a map built once per render, so
+            filters can call it for every value they output.
+
+            Example:
+                node = engine.register_style('bold', **{'fo:font-weight': 'bold'})
+        """
+
+        style_node = self.get_style_by_name(style_name)
+        if style_node is None:
+            style_node = self.insert_style_in_content(
+                style_name, attributes, **style_properties)
+
+        return style_node
 
     def markdown_filter(self, markdown_text):
         """
@@ -716,7 +2551,29 @@ class Renderer(object):
         if not isinstance(markdown_text, basestring):
             return ''
 
-        from xml.dom import Node
+        converted = self.markdown_cache.get(markdown_text)
+        if self._stats is not None:
+            self._stats.count('markdown_calls')
+            self._stats.count('markdown_cache_hits', converted is not None)
+
+        if converted is None:
+            converted = self._markdown_to_odt(markdown_text)
+            self.markdown_cache.set(markdown_text, converted,
+                                    len(markdown_text) + len(converted[0]))
+
+        odt_text, styles = converted
+        for name, attributes, properties in styles:
+            # The cached conversion may come from another document
+            self.register_style(name, attributes, **properties)
+
+        return odt_text
+
+    def _markdown_to_odt(self, markdown_text):
+        """
+            Convert a markdown text into a ODT formated text. Returns the
+            text and a list of (name, attributes, properties) tuples, the
+            styles it uses that must be inserted into content.xml.
+        """
         from markdown_map import transform_map
 
         try:
@@ -724,86 +2581,20 @@ class Renderer(object):
         except ImportError:
             raise SecretaryError('Could not import markdown2 library. Install it using "pip install markdown2"')
 
-        styles_cache = {}   # cache styles searching
-        html_text = markdown(markdown_text)
-        xml_object = parseString('<html>%s</html>' % html_text.encode('ascii', 'xmlcharrefreplace'))
-
-        # Transform HTML tags as specified in transform_map
-        # Some tags may require extra attributes in ODT.
-        # Additional attributes are indicated in the 'attributes' property
-
-        for tag in transform_map:
-            html_nodes = xml_object.getElementsByTagName(tag)
-            for html_node in html_nodes:
-                odt_node = xml_object.createElement(transform_map[tag]['replace_with'])
-
-                # Transfer child nodes
-                if html_node.hasChildNodes():
-                    # We can't directly insert text into a text:list-item element.
-                    # The content of the item most be wrapped inside a container
-                    # like text:p. When there's not a double linebreak separating
-                    # list elements, markdown2 creates <li> elements without wraping
-                    # their contents inside a container. Here we automatically create
-                    # the container if one was not created by markdown2.
-                    if (tag=='li' and html_node.childNodes[0].localName != 'p'):
-                        container = xml_object.createElement('text:p')
-                        odt_node.appendChild(container)
-                    else:
-                        container = odt_node
-
-                    for child_node in html_node.childNodes:
-                        container.appendChild(child_node.cloneNode(True))
-
-                # Add style-attributes defined in transform_map
-                if 'style_attributes' in transform_map[tag]:
-                    for k, v in transform_map[tag]['style_attributes'].items():
-                        odt_node.setAttribute('text:%s' % k, v)
-
-                # Add defined attributes
-                if 'attributes' in transform_map[tag]:
-                    for k, v in transform_map[tag]['attributes'].items():
-                        odt_node.setAttribute(k, v)
-
-                    # copy original href attribute in <a> tag
-                    if tag == 'a':
-                        if html_node.hasAttribute('href'):
-                            odt_node.setAttribute('xlink:href',
-                                html_node.getAttribute('href'))
-
-                # Does the node need to create an style?
-                if 'style' in transform_map[tag]:
-                    name = transform_map[tag]['style']['name']
-                    if not name in styles_cache:
-                        style_node = self.get_style_by_name(name)
-
-                        if style_node is None:
-                            # Create and cache the style node
-                            style_node = self.insert_style_in_content(
-                                name, transform_map[tag]['style'].get('attributes', None),
-                                **transform_map[tag]['style']['properties'])
-                            styles_cache[name] = style_node
-
-                html_node.parentNode.replaceChild(odt_node, html_node)
-
-        def node_to_string(node):
-            result = node.toxml()
-
-            # linebreaks in preformated nodes should be converted to <text:line-break/>
-            if (node.__class__.__name__ != 'Text') and \
-                (node.getAttribute('text:style-name') == 'Preformatted_20_Text'):
-                result = result.replace('\n', '<text:line-break/>')
-
-            # All double linebreak should be replaced with an empty paragraph
-            return result.replace('\n\n', '<text:p text:style-name="Standard"/>')
-
-
-        return ''.join(node_as_str for node_as_str in map(node_to_string,
-                xml_object.getElementsByTagName('html')[0].childNodes))
+        writer = MarkdownWriter(transform_map)
+        writer.feed(markdown(markdown_text))
+        writer.close()
+
+        return writer.getvalue(), writer.styles
 
     def image_filter(self, value, *args, **kwargs):
         """Store value into template_images and return the key name where this
         method stored it. The value returned it later used to load the image
         from media loader and finally inserted into the final ODT document."""
+        if self._render_state.streaming:
+            raise SecretaryError('Images are not supported in the content of '
+                                 'streamed documents')
+
         key = uuid4().hex
         self.template_images[key] = {
             'value': value,
@@ -814,41 +2605,593 @@ class Renderer(object):
         return key
 
 
+class CompiledTemplate(object):
+    """
+        A template prepared by Renderer.compile. Keeps the untouched
+        archive members and the compiled jinja templates of content.xml
+        and styles.xml, so it can be rendered many times without preparing
+        the ODT document again.
+
+        Basic use example:
+            engine = Renderer()
+            template = engine.compile('template.odt')
+            result = template.render(var1=val1, var2=val2, ...)
+    """
+
+    def __init__(self, renderer, files, content_head, content_tail,
+                 content_source, styles_source, cache_key=None, flat=False,
+                 async_only=False):
+        self.renderer = renderer
+        self.files = files
+        # Flat ODF template, rendered into a Flat ODF document
+        self.flat = flat
+        self.content_head = content_head
+        self.content_tail = content_tail
+        self.content_source = content_source
+        self.styles_source = styles_source
+
+        self.cache_key = cache_key
+        self._templates = None
+        self._async_templates = None
+        # Templates compiled for render_async only do not need the sync ones
+        if not async_only:
+            self._sync_templates()
+
+    def _sync_templates(self):
+        # Compile, once, the jinja templates of content.xml and styles.xml.
+        # Templates are named after their cache key, to find their code in
+        # the renderer bytecode cache.
+        if self._templates is None:
+            renderer = self.renderer
+            cache_key = self.cache_key
+            self._templates = (
+                renderer._compile_xml(
+                    self.content_source,
+                    cache_key and cache_key + '/content.xml'),
+                renderer._compile_xml(
+                    self.styles_source,
+                    cache_key and cache_key + '/styles.xml'),
+            )
+
+        return self._templates
+
+    @property
+    def content_template(self):
+        return self._sync_templates()[0]
+
+    @property
+    def styles_template(self):
+        return self._sync_templates()[1]
+
+    def _begin_render(self):
+        # Set up the renderer state of a new render. Called within the
+        # render state of Renderer._collect_stats.
+        renderer = self.renderer
+        renderer.log.debug('Initing a template rendering')
+        renderer.files = dict(self.files)
+        renderer._render_state.flat = self.flat
+
+        # Filters may work with content and manifest xml objects. They are
+        # parsed only when a filter asks for them. Content is parsed from
+        # its head and tail, with an empty office:body node.
+        renderer._content_source = ''.join([
+            self.content_head, '<office:body/>', self.content_tail])
+        renderer._manifest_source = self.files.get('META-INF/manifest.xml')
+
+    def _content_parts(self):
+        # Returns content.xml text before and after the office:body node
+        renderer = self.renderer
+        if renderer._content is None:
+            return self.content_head, self.content_tail
+
+        # A filter requested content, it may have updated it (i.e.
+        # inserting a new style)
+        head, _, tail = renderer._split_body(renderer._content.toxml())
+        return head, tail
+
+    def _content_xml(self, body):
+        # Returns content.xml text with the rendered office:body node
+        head, tail = self._content_parts()
+        return ''.join([head, body, tail])
+
+    def _register_markdown_styles(self):
+        # Insert the styles markdown_filter may use. A streamed content.xml
+        # head is written before its body is rendered, so they can not be
+        # inserted on demand.
+        from markdown_map import transform_map
+
+        for rule in transform_map.values():
+            style = rule.get('style')
+            if style:
+                self.renderer.register_style(
+                    style['name'], style.get('attributes'), **style['properties'])
+
+    def _stream_content(self, head, chunks, tail):
+        # Yields the encoded content.xml, with the body `chunks` between
+        # head and tail. It is checked by an incremental expat parser when
+        # check_xml is set.
+        renderer = self.renderer
+        parser = ParserCreate() if renderer.check_xml else None
+        for text in chain([head], chunks, [tail]):
+            data = renderer._encode_xml(text)
+            if parser is not None:
+                try:
+                    renderer._timed('check_xml', parser.Parse, data, False)
+                except ExpatError as e:
+                    raise ExpatError('ExpatError "%s" at line %d, column %d' % (
+                        ErrorString(e.code), e.lineno, e.offset))
+
+            yield data
+
+        if parser is not None:
+            try:
+                parser.Parse(b'', True)
+            except ExpatError as e:
+                raise ExpatError('ExpatError "%s" at line %d, column %d' % (
+                    ErrorString(e.code), e.lineno, e.offset))
+
+    def _end_render(self, content, styles):
+        # Returns the archive members of the rendered document
+        renderer = self.renderer
+        renderer.log.debug('Template rendering finished')
+
+        files = renderer.files
+        if isinstance(content, StreamedZipMember):
+            files['content.xml'] = content
+        else:
+            files['content.xml'] = renderer._encode_xml(content)
+        files['styles.xml']  = renderer._encode_xml(styles)
+        if renderer._manifest is not None:
+            files['META-INF/manifest.xml'] = renderer._encode_xml(renderer._manifest.toxml())
+
+        return files
+
+    def _pack(self, files, fileobj=None):
+        # Pack the rendered members into a zip archive, or a Flat ODF
+        # document for flat templates. Returns the file object written.
+        renderer = self.renderer
+        if self.flat:
+            return renderer._timed('pack', renderer._pack_flat_document,
+                                   files, fileobj)
+
+        return renderer._timed('pack', renderer._pack_document, files,
+                               fileobj)
+
+    def _render_files(self, **kwargs):
+        # Render the template and return the archive members of the
+        # resulting document
+        renderer = self.renderer
+        self._begin_render()
+
+        # Render the office:body node of content.xml
+        body = renderer._render_template(self.content_template, **kwargs)
+        content = renderer._finalize_xml(self._content_xml(body))
+
+        # Render styles.xml
+        styles = renderer._finalize_xml(
+            renderer._render_template(self.styles_template, **kwargs))
+
+        return self._end_render(content, styles)
+
+    def render(self, **kwargs):
+        """
+            Render the template
+
+            args:
+                **kwargs: Template variables. Similar to jinja2
+
+            returns:
+                A binary stream which contains the rendered document.
+        """
+
+        renderer = self.renderer
+        with renderer._collect_stats('render'):
+            files = self._render_files(**kwargs)
+            return self._pack(files).getvalue()
+
+    def render_async(self, **kwargs):
+        """
+            Render the template using jinja's async mode. Awaitable template
+            variables are awaited before rendering and media loaders can be
+            coroutine functions; the images of a document are loaded
+            concurrently.
+
+            args:
+                **kwargs: Template variables. Values can be awaitables.
+
+            returns:
+                A coroutine returning the rendered document.
+        """
+        from secretary_async import render_async
+
+        return render_async(self, **kwargs)
+
+    def render_to(self, fileobj, **kwargs):
+        """
+            Render the template writing the document straight into `fileobj`
+
+            args:
+                fileobj: A writable file object. On Python 3.5 or later it
+                         does not need to be seekable, so a socket file or
+                         a pipe can be used.
+                **kwargs: Template variables. Similar to jinja2
+        """
+
+        renderer = self.renderer
+        with renderer._collect_stats('render'):
+            files = self._render_files(**kwargs)
+            self._pack(files, fileobj)
+
+    def stream_to(self, fileobj, zip64=False, **kwargs):
+        """
+            Render the template writing the document into `fileobj` while
+            content.xml is rendered. content.xml is generated by jinja in
+            chunks that are compressed straight into its archive member, so
+            memory use does not grow with the size of the document. Requires
+            Python 3.6 or later.
+
+            Images can be used in styles.xml only, and filters can not insert
+            styles into content.xml, except markdown ones which are inserted
+            beforehand. If rendering fails, `fileobj` holds a partial
+            document.
+
+            args:
+                fileobj: A writable file object. It does not need to be
+                         seekable.
+                zip64: Write content.xml with ZIP64 sizes, needed when it
+                       is larger than 2 GiB. Without it, rendering a larger
+                       content.xml fails.
+                **kwargs: Template variables. Similar to jinja2
+        """
+
+        renderer = self.renderer
+        with renderer._collect_stats('render') as state:
+            self._begin_render()
+            if 'markdown' in self.content_source:
+                self._register_markdown_styles()
+
+            # styles.xml is rendered first, images can be used in it
+            styles = renderer._finalize_xml(
+                renderer._render_template(self.styles_template, **kwargs))
+
+            head, tail = self._content_parts()
+            state.streaming = True
+            chunks = renderer._generate_template(self.content_template,
+                                                 **kwargs)
+            content = StreamedZipMember(
+                self._stream_content(head, chunks, tail), zip64)
+
+            # content.xml is rendered while it is packed
+            files = self._end_render(content, styles)
+            self._pack(files, fileobj)
+
+
+    def render_many(self, contexts, workers=None, return_exceptions=False):
+        """
+            Render the template once for every context in `contexts` using a
+            pool of worker processes.
+
+            Worker processes are forked from the current one, so they share
+            this compiled template and no preparation is done again. Only a
+            few contexts per worker are sent to the pool at once, so
+            `contexts` can be a lazy iterator of any length.
+
+            args:
+                contexts: An iterable of dicts with template variables.
+                workers: Number of worker processes. Defaults to the number
+                         of CPUs. With a single worker, contexts are rendered
+                         in the current process.
+                return_exceptions: When a render fails, yield its exception
+                                   in place of the document instead of
+                                   raising it, so the other contexts are
+                                   still rendered.
+
+            returns:
+                An iterator of (index, document) tuples, in completion order.
+                `index` is the position of the context in `contexts`.
+        """
+        import multiprocessing
+
+        # Worker processes are forked and set up by the initializer of
+        # ProcessPoolExecutor, which takes one from Python 3.7
+        workers = workers or multiprocessing.cpu_count()
+        if workers > 1 and sys.version_info < (3, 7):
+            self.renderer.log.warning(
+                'Worker processes require Python 3.7, rendering in current '
+                'process')
+            workers = 1
+        elif workers > 1 and \
+                'fork' not in multiprocessing.get_all_start_methods():
+            self.renderer.log.warning(
+                'Processes can not be forked, rendering in current process')
+            workers = 1
+
+        if workers == 1:
+            for index, context in enumerate(contexts):
+                try:
+                    document = self.render(**context)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    document = e
+
+                yield index, document
+            return
+
+        from concurrent.futures import (ProcessPoolExecutor, wait,
+                                        FIRST_COMPLETED)
+
+        max_pending = workers * 2
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_render_worker, initargs=(self,))
+
+        def results(done):
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    yield index, e
+
+        with executor:
+            pending = {}    # future: context index
+            for index, context in enumerate(contexts):
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for result in results(done):
+                        yield result
+
+                future = executor.submit(_render_in_worker, index, context)
+                pending[future] = index
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for result in results(done):
+                    yield result
+
+
+# Compiled template used by render_many worker processes
+_worker_template = None
+
+def _init_render_worker(compiled_template):
+    global _worker_template
+    _worker_template = compiled_template
+
+def _render_in_worker(index, context):
+    return index, _worker_template.render(**context)
+
+
 def render_template(template, **kwargs):
     """
         Render a ODF template file
     """
 
-    engine = Renderer(file)
-    return engine.render(**kwargs)
+    engine = Renderer()
+    return engine.render(template, **kwargs)
+
+
+# ************************************************
+#
+#           COMMAND LINE
+#
+# ************************************************
+
+def _read_contexts(lines, failures):
+    """Yields a (line number, context) tuple for every JSON object in
+    `lines`. Invalid lines are reported to `failures`, a function taking
+    the line number and the error message."""
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            context = json.loads(line)
+        except ValueError as e:
+            failures(line_number, 'Invalid JSON: %s' % e)
+            continue
+
+        if not isinstance(context, dict):
+            failures(line_number, 'Context is not a JSON object')
+            continue
+
+        yield line_number, context
+
+
+class _DirectoryWriter(object):
+    # Writes rendered documents as files of a directory. Existing files
+    # are not overwritten, so duplicate names are found without keeping
+    # the names written.
+    def __init__(self, directory):
+        self.directory = directory
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, name, document):
+        try:
+            fd = os.open(path.join(self.directory, name),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise SecretaryError('Document %s already exists' % name)
+            raise
+
+        with os.fdopen(fd, 'wb') as output:
+            output.write(document)
+
+    def close(self):
+        pass
+
+
+class _TarWriter(object):
+    # Writes rendered documents into a tar stream
+    def __init__(self, fileobj):
+        import tarfile
+
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|')
+        # Names written, a tar stream can not be searched for them
+        self.names = set()
+
+    def write(self, name, document):
+        import tarfile
+
+        if name in self.names:
+            raise SecretaryError('Document %s already exists' % name)
+        self.names.add(name)
+
+        info = tarfile.TarInfo(name)
+        info.size = len(document)
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(document))
+        # TarFile keeps every member written; a stream does not need them
+        self.tar.members = []
+
+    def close(self):
+        self.tar.close()
+
+
+def main(argv=None):
+    """
+        Command line bulk renderer. Renders a template once for every JSON
+        object of a JSON Lines stream. Run with --help for its usage.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='secretary',
+        description='Render an ODF template once for every context of a '
+                    'JSON Lines (NDJSON) file.')
+    parser.add_argument('template', help='ODF template file')
+    parser.add_argument('contexts', nargs='?', default='-',
+                        help='JSON Lines file with a context per line. '
+                             'Defaults to standard input')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('-o', '--output-dir',
+                        help='Write every document into this directory')
+    output.add_argument('-t', '--tar',
+                        help='Write documents into this tar file, "-" for '
+                             'standard output')
+    parser.add_argument('-n', '--name-field',
+                        help='Context field with the document file name. '
+                             'Documents are named after their line number '
+                             'by default')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes. Defaults to the '
+                             'number of CPUs')
+    parser.add_argument('-r', '--report',
+                        help='Write a JSON Lines report, a line per record')
+    parser.add_argument('--media-path', default='',
+                        help='Path used to load images')
+    parser.add_argument('--cache-dir', help='Template cache directory')
+    parser.add_argument('--ascii-output', action='store_true',
+                        help='Write non ASCII characters as XML character '
+                             'references instead of UTF-8')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log rendering details and errors')
+    args = parser.parse_args(argv)
+
+    # Failed records are already reported, only log on request
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    extension = path.splitext(args.template)[1] or '.odt'
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    report = open(args.report, 'w') if args.report else None
+    stats = {'rendered': 0, 'failed': 0}
+
+    def record(line_number, name=None, error=None):
+        if error is None:
+            stats['rendered'] += 1
+        else:
+            stats['failed'] += 1
+            print('Line %d: %s' % (line_number, error), file=sys.stderr)
+
+        if report is not None:
+            report.write(json.dumps({'line': line_number, 'output': name,
+                                     'error': error}) + '\n')
+
+    def failures(line_number, error):
+        record(line_number, error=error)
+
+    if args.contexts == '-':
+        lines = io.TextIOWrapper(stdin, encoding='utf-8')
+    else:
+        lines = io.open(args.contexts, encoding='utf-8')
+
+    output = None
+    if args.output_dir:
+        writer = _DirectoryWriter(args.output_dir)
+    elif args.tar == '-':
+        writer = _TarWriter(stdout)
+    else:
+        output = open(args.tar, 'wb')
+        writer = _TarWriter(output)
+
+    engine = Renderer(media_path=args.media_path, cache_dir=args.cache_dir,
+                      ascii_output=args.ascii_output)
+    compiled = engine.compile(args.template)
+
+    # Names of the documents being rendered, by render_many index. Only a
+    # few contexts are rendered at once, so it does not grow.
+    pending = {}
+
+    def contexts():
+        # render_many numbers the contexts it receives, skipped records
+        # do not take an index
+        index = 0
+        for line_number, context in _read_contexts(lines, failures):
+            name = context.get(args.name_field) if args.name_field else None
+            if name:
+                name = path.basename('%s' % name)
+                if not path.splitext(name)[1]:
+                    name += extension
+            else:
+                name = '%d%s' % (line_number, extension)
+
+            pending[index] = (line_number, name)
+            index += 1
+            yield context
+
+    start = timer()
+    try:
+        for index, document in compiled.render_many(
+                contexts(), args.workers, return_exceptions=True):
+            line_number, name = pending.pop(index)
+            if isinstance(document, Exception):
+                record(line_number, error='%s: %s' % (
+                    type(document).__name__, document))
+                continue
+
+            try:
+                writer.write(name, document)
+            except SecretaryError as e:
+                # Names are checked by the writer, a document of another
+                # record, or of a previous run, has it
+                record(line_number, error='%s' % e)
+                continue
+
+            record(line_number, name)
+    finally:
+        writer.close()
+        if output is not None:
+            output.close()
+        lines.close()
+        if report is not None:
+            report.close()
+
+    elapsed = timer() - start
+    print('Rendered %d documents in %.2fs (%.1f documents/s), %d failed' % (
+        stats['rendered'], elapsed, stats['rendered'] / elapsed if elapsed else 0,
+        stats['failed']), file=sys.stderr)
+
+    return 1 if stats['failed'] else 0
 
 
 if __name__ == "__main__":
-    import os
-    from datetime import datetime
-
-    def read(fname):
-        return open(os.path.join(os.path.dirname(__file__), fname)).read()
-
-    document = {
-        'datetime': datetime.now(),
-        'md_sample': read('README.md')
-    }
-
-    countries = [
-        {'country': 'United States', 'capital': 'Washington', 'cities': ['miami', 'new york', 'california', 'texas', 'atlanta']},
-        {'country': 'England', 'capital': 'London', 'cities': ['gales']},
-        {'country': 'Japan', 'capital': 'Tokio', 'cities': ['hiroshima', 'nagazaki']},
-        {'country': 'Nicaragua', 'capital': 'Managua', 'cities': ['leon', 'granada', 'masaya']},
-        {'country': 'Argentina', 'capital': 'Buenos aires'},
-        {'country': 'Chile', 'capital': 'Santiago'},
-        {'country': 'Mexico', 'capital': 'MExico City', 'cities': ['puebla', 'cancun']},
-    ]
-
-    render = Renderer()
-    result = render.render('simple_template.odt', countries=countries, document=document)
-
-    output = open('rendered.odt', 'wb')
-    output.write(result)
-
-    print("Template rendering finished! Check rendered.odt file.")
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Secretary async rendering
+    Implementation of Renderer.render_async and
+    CompiledTemplate.render_async. It lives in its own
+    module because it uses syntax not available in every Python version
+    supported by secretary.py.
+
+    To render a template:
+        engine = Renderer()
+        result = await engine.render_async(template_file, foo=bar, ...)
+"""
+
+import asyncio
+import inspect
+from timeit import default_timer as timer
+
+
+async def _resolve(value):
+    # Await value if it is awaitable
+    if inspect.isawaitable(value):
+        return await value
+
+    return value
+
+
+async def _resolve_context(context):
+    # Await every awaitable template variable, concurrently
+    keys = list(context)
+    values = await asyncio.gather(*[_resolve(context[key]) for key in keys])
+
+    return dict(zip(keys, values))
+
+
+async def _render_template(renderer, jinja_template, context):
+    # Async version of Renderer._render_template
+    renderer.log.debug('Rendering XML object')
+
+    try:
+        renderer.template_images = dict()
+        stats, start = renderer._stats, timer()
+        result = await jinja_template.render_async(**context)
+        if stats is not None:
+            stats.add_time('render', timer() - start)
+
+        return renderer._timed('encode_escape_chars',
+                               renderer._encode_escape_chars, result)
+    except:
+        renderer.log.error('Error rendering template', exc_info=True)
+        raise
+    finally:
+        renderer.log.debug('Rendering xml object finished')
+
+
+async def replace_images(renderer, xml_document):
+    """Async version of Renderer.replace_images. The media loader can be a
+    coroutine function, every image of `xml_document` is loaded
+    concurrently."""
+    renderer.log.debug('Inserting images')
+
+    placeholders = []
+    loads = []
+    for frame, image_node, key in renderer._image_placeholders(xml_document):
+        frame_attrs = xml_document.attributes(frame)
+        image_attrs = xml_document.attributes(image_node)
+        placeholders.append((xml_document, frame, image_node, key,
+                             frame_attrs, image_attrs))
+        loads.append(_load_media(renderer, key, frame_attrs, image_attrs))
+
+    images = await asyncio.gather(*loads)
+    for placeholder, image in zip(placeholders, images):
+        renderer._update_image(*placeholder, image=image)
+        renderer._count('images')
+
+
+async def _load_media(renderer, key, frame_attrs, image_attrs):
+    # Async version of Renderer._load_media
+    cache_key = renderer._media_cache_key(key, frame_attrs, image_attrs)
+    image = renderer._cached_media(cache_key, frame_attrs, image_attrs)
+    if image is not None:
+        renderer._count('media_cache_hits')
+        return image
+
+    image = await _resolve(renderer.media_callback(
+        renderer.template_images[key]['value'],
+        *renderer.template_images[key]['args'],
+        frame_attrs=frame_attrs,
+        image_attrs=image_attrs,
+        **renderer.template_images[key]['kwargs']))
+
+    return renderer._cache_media(cache_key, image, frame_attrs, image_attrs)
+
+
+async def _finalize_xml(renderer, xml_text):
+    # Async version of Renderer._finalize_xml
+    if not renderer.template_images:
+        return renderer._finalize_xml(xml_text)
+
+    final_xml = renderer._timed('parse_rendered', renderer._parse_xml, xml_text)
+
+    stats, start = renderer._stats, timer()
+    await replace_images(renderer, final_xml)
+    if stats is not None:
+        stats.add_time('replace_images', timer() - start)
+
+    return renderer._timed('serialize', final_xml.serialize)
+
+
+def _async_templates(compiled):
+    # Compile, once, the templates of `compiled` on an async environment.
+    # Async code is kept in the bytecode cache apart from the sync one.
+    if compiled._async_templates is None:
+        renderer = compiled.renderer
+        environment = renderer.environment.overlay(enable_async=True)
+        cache_key = compiled.cache_key
+        compiled._async_templates = (
+            renderer._compile_xml(
+                compiled.content_source,
+                cache_key and cache_key + '/content.xml.async', environment),
+            renderer._compile_xml(
+                compiled.styles_source,
+                cache_key and cache_key + '/styles.xml.async', environment),
+        )
+
+    return compiled._async_templates
+
+
+async def render_async(compiled, **kwargs):
+    """
+        Render a CompiledTemplate using jinja's async mode
+
+        args:
+            compiled: A CompiledTemplate instance
+            **kwargs: Template variables. Values can be awaitables.
+
+        returns:
+            The rendered document as bytes.
+    """
+    renderer = compiled.renderer
+    context = await _resolve_context(kwargs)
+
+    with renderer._collect_stats('render'):
+        content_template, styles_template = _async_templates(compiled)
+        compiled._begin_render()
+
+        # Render the office:body node of content.xml
+        body = await _render_template(renderer, content_template, context)
+        content = await _finalize_xml(renderer, compiled._content_xml(body))
+
+        # Render styles.xml
+        styles = await _finalize_xml(renderer, await _render_template(
+            renderer, styles_template, context))
+
+        files = compiled._end_render(content, styles)
+        return compiled._pack(files).getvalue()
+
+
+async def render_template(renderer, template, **kwargs):
+    """
+        Implementation of Renderer.render_async. The template is compiled
+        for jinja's async mode only, as part of the render.
+
+        args:
+            renderer: A Renderer instance
+            template: A template file. Could be a string or a file instance
+            **kwargs: Template variables. Values can be awaitables.
+
+        returns:
+            The rendered document as bytes.
+    """
+    with renderer._collect_stats('render'):
+        compiled = renderer._compile(template, async_only=True)
+        return await render_async(compiled, **kwargs)
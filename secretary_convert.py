@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+
+"""
+Secretary document conversion
+    A pool of long lived converter processes, to turn rendered documents
+    into PDF or other formats without starting an office suite for every
+    document. Converter processes are recycled after a number of jobs,
+    checked before being reused after a while idle, and killed when a
+    conversion takes longer than its timeout.
+
+    To convert documents to PDF with LibreOffice:
+        with ConverterPool(workers=2) as pool:
+            pdf = render_and_convert('invoice.odt', pool, invoice=invoice)
+
+    The converter command is pluggable. Converter processes read requests
+    from their standard input and answer them on their standard output,
+    one JSON object per line:
+        {"command": "ping"}
+        {"command": "convert", "input": "/tmp/a.odt",
+         "output": "/tmp/a.pdf", "format": "pdf"}
+    and answer {"ok": true} or {"ok": false, "error": "..."}. `serve`
+    implements this protocol around a conversion function. The default
+    command runs this module, which converts with LibreOffice through its
+    Python UNO bridge.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from os import path
+from uuid import uuid4
+from queue import Queue, Empty
+
+from secretary import Renderer, CompiledTemplate, SecretaryError
+
+
+# Seconds a converter process has to answer a health check
+HEALTH_CHECK_TIMEOUT = 10
+
+
+class ConversionError(SecretaryError):
+    """A document could not be converted."""
+
+
+class ConversionTimeout(ConversionError):
+    """A conversion, or the wait for a free converter, took too long."""
+
+
+def libreoffice_command(soffice='soffice'):
+    """Returns the command of a converter process using LibreOffice's
+    `soffice` executable."""
+    worker = path.splitext(path.abspath(__file__))[0] + '.py'
+    return [sys.executable, worker, '--soffice', soffice]
+
+
+class ConverterProcess(object):
+    """
+        A converter process started from `command`. Requests are sent one
+        at a time; its answers are read by a thread, so they can be waited
+        for with a timeout.
+    """
+
+    def __init__(self, command, start_timeout):
+        self.log = logging.getLogger(__name__)
+        self.jobs = 0
+        self.last_used = time.time()
+
+        # In its own session, so the office suite it may start is killed
+        # along with it
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            start_new_session=os.name == 'posix')
+        self._responses = Queue()
+        reader = threading.Thread(target=self._read_responses)
+        reader.daemon = True
+        reader.start()
+
+        try:
+            # It answers once it is ready to convert
+            self.request({'command': 'ping'}, start_timeout)
+        except ConversionError:
+            self.kill()
+            raise
+
+    def _read_responses(self):
+        for line in iter(self.process.stdout.readline, b''):
+            self._responses.put(line)
+        self._responses.put(None)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, message, timeout):
+        """Send `message` and return its answer. Raises ConversionTimeout,
+        killing the process, when there is no answer within `timeout`
+        seconds."""
+        try:
+            self.process.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            raise ConversionError('Converter process exited with status %s' %
+                                  self.process.poll())
+
+        try:
+            line = self._responses.get(timeout=timeout)
+        except Empty:
+            self.kill()
+            raise ConversionTimeout('Converter process did not answer in %ss' %
+                                    timeout)
+
+        if line is None:
+            raise ConversionError('Converter process exited with status %s' %
+                                  self.process.wait())
+
+        try:
+            response = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.kill()
+            raise ConversionError('Invalid converter answer: %r' % line)
+
+        if not response.get('ok'):
+            raise ConversionError(response.get('error') or 'Conversion failed')
+
+        return response
+
+    def ping(self, timeout=HEALTH_CHECK_TIMEOUT):
+        """Returns True if the process answers a health check."""
+        try:
+            self.request({'command': 'ping'}, timeout)
+        except ConversionError:
+            return False
+
+        return True
+
+    def convert(self, input, output, format, timeout):
+        self.jobs += 1
+        self.request({'command': 'convert', 'input': input, 'output': output,
+                      'format': format}, timeout)
+        self.last_used = time.time()
+
+    def kill(self):
+        if not self.alive():
+            return
+
+        try:
+            if os.name == 'posix':
+                os.killpg(self.process.pid, 9)
+            else:
+                self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def close(self, timeout=10):
+        """Ask the process to exit, closing its input, and kill it if it
+        does not within `timeout` seconds."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except (IOError, OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+
+class ConverterPool(object):
+    """
+        Pool of long lived converter processes. It can be shared by many
+        threads; each conversion takes a process of its own.
+
+        args:
+            command: Command of the converter processes, as a list. Defaults
+                     to libreoffice_command().
+            workers: Number of converter processes. They are started when
+                     first needed.
+            max_jobs: Conversions done by a process before it is replaced by
+                      a new one, to bound the memory an office suite leaks.
+            timeout: Seconds a conversion can take. The process is killed
+                     after that.
+            queue_timeout: Seconds to wait for a free converter process.
+                           Waits forever by default.
+            start_timeout: Seconds a new process has to be ready.
+            health_check_interval: Processes idle for longer than this many
+                                   seconds are checked before being used,
+                                   and replaced if they do not answer.
+    """
+
+    def __init__(self, command=None, workers=1, max_jobs=100, timeout=120,
+                 queue_timeout=None, start_timeout=60,
+                 health_check_interval=30):
+        self.log = logging.getLogger(__name__)
+        self.command = command or libreoffice_command()
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.start_timeout = start_timeout
+        self.health_check_interval = health_check_interval
+        self.counters = dict(started=0, recycled=0, replaced=0, timeouts=0,
+                             conversions=0)
+
+        # A slot for every worker, holding its idle process, or None when
+        # it has to be started
+        self._slots = Queue()
+        for i in range(workers):
+            self._slots.put(None)
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.work_dir = tempfile.mkdtemp(prefix='secretary-convert-')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start(self):
+        process = ConverterProcess(self.command, self.start_timeout)
+        with self._lock:
+            if self._closed:
+                process.close()
+                raise ConversionError('Converter pool is closed')
+
+            self._processes.add(process)
+            self.counters['started'] += 1
+
+        return process
+
+    def _discard(self, process, counter=None):
+        with self._lock:
+            self._processes.discard(process)
+            if counter:
+                self.counters[counter] += 1
+        process.close()
+
+    def _acquire(self):
+        # Returns a process ready to convert
+        try:
+            process = self._slots.get(timeout=self.queue_timeout)
+        except Empty:
+            raise ConversionTimeout('No converter process was free in %ss' %
+                                    self.queue_timeout)
+
+        if self._closed:
+            # The pool was closed while waiting. The slot is put back, so
+            # other threads waiting for one raise too.
+            if process is not None:
+                self._discard(process)
+            self._slots.put(None)
+            raise ConversionError('Converter pool is closed')
+
+        try:
+            if process is not None and not process.alive():
+                self.log.warning('Converter process exited, replacing it')
+                self._discard(process, 'replaced')
+                process = None
+
+            if (process is not None and time.time() - process.last_used >
+                    self.health_check_interval):
+                if process.ping():
+                    process.last_used = time.time()
+                else:
+                    self.log.warning('Converter process failed its health '
+                                     'check, replacing it')
+                    self._discard(process, 'replaced')
+                    process = None
+
+            if process is None:
+                process = self._start()
+        except:
+            self._slots.put(None)
+            raise
+
+        return process
+
+    def _release(self, process):
+        if self._closed:
+            # close() did not wait for this process, which was converting
+            self._discard(process)
+            process = None
+        elif process.jobs >= self.max_jobs:
+            self._discard(process, 'recycled')
+            process = None
+
+        self._slots.put(process)
+
+    def convert(self, document, format='pdf', timeout=None, extension=None):
+        """
+            Convert a document.
+
+            args:
+                document: The document, as bytes, like Renderer.render
+                          returns it.
+                format: Output format, like 'pdf' or 'docx'.
+                timeout: Seconds the conversion can take. Defaults to the
+                         pool timeout.
+                extension: Extension of the document file given to the
+                           converter. Guessed between '.odt' and '.fodt' by
+                           default.
+
+            returns:
+                The converted document, as bytes.
+        """
+        if self._closed:
+            raise ConversionError('Converter pool is closed')
+
+        if extension is None:
+            extension = '.odt' if document[:2] == b'PK' else '.fodt'
+
+        name = path.join(self.work_dir, uuid4().hex)
+        input, output = name + extension, '%s.%s' % (name, format)
+
+        process = self._acquire()
+        try:
+            with open(input, 'wb') as input_file:
+                input_file.write(document)
+        except:
+            self._release(process)
+            if path.exists(input):
+                os.remove(input)
+            raise
+
+        try:
+            process.convert(input, output, format, timeout or self.timeout)
+        except ConversionTimeout:
+            self._discard(process, 'timeouts')
+            self._slots.put(None)
+            raise
+        except ConversionError:
+            if process.alive():
+                self._release(process)
+            else:
+                self._discard(process, 'replaced')
+                self._slots.put(None)
+            raise
+        except:
+            self._discard(process)
+            self._slots.put(None)
+            raise
+        else:
+            self._release(process)
+        finally:
+            os.remove(input)
+
+        try:
+            with open(output, 'rb') as output_file:
+                converted = output_file.read()
+        except (IOError, OSError):
+            raise ConversionError('Converter did not write %s' % output)
+        finally:
+            if path.exists(output):
+                os.remove(output)
+
+        with self._lock:
+            self.counters['conversions'] += 1
+
+        return converted
+
+    def close(self):
+        """Stop every converter process."""
+        self._closed = True
+        with self._lock:
+            processes = list(self._processes)
+            self._processes.clear()
+
+        for process in processes:
+            process.close()
+
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def render_and_convert(template, pool, format='pdf', renderer=None, **kwargs):
+    """
+        Render a template with Renderer.render and convert the document
+        with a ConverterPool.
+
+        args:
+            template: A template file, or a CompiledTemplate.
+            pool: A ConverterPool.
+            format: Output format, like 'pdf' or 'docx'.
+            renderer: Renderer used to render template files. A new one is
+                      used by default.
+            **kwargs: Template variables.
+
+        returns:
+            The converted document, as bytes.
+    """
+    if isinstance(template, CompiledTemplate):
+        document = template.render(**kwargs)
+    else:
+        document = (renderer or Renderer()).render(template, **kwargs)
+
+    return pool.convert(document, format)
+
+
+# ************************************************
+#
+#           CONVERTER PROCESS
+#
+# ************************************************
+
+def serve(convert, input, output):
+    """
+        Answer the converter requests read from `input`, one JSON object
+        per line, on `output`, until `input` is closed. `convert` is called
+        with the input file, output file and format of every conversion.
+    """
+    for line in input:
+        if not line.strip():
+            continue
+
+        try:
+            request = json.loads(line)
+            command = request.get('command')
+            if command == 'convert':
+                convert(request['input'], request['output'], request['format'])
+            elif command != 'ping':
+                raise ValueError('Unknown command %r' % command)
+            response = {'ok': True}
+        except Exception as e:
+            response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+
+        output.write(json.dumps(response) + '\n')
+        output.flush()
+
+
+class LibreOfficeConverter(object):
+    """
+        Converts documents with a headless LibreOffice, started once and
+        driven through its Python UNO bridge.
+    """
+
+    FILTERS = {
+        'pdf': 'writer_pdf_Export',
+        'docx': 'MS Word 2007 XML',
+        'doc': 'MS Word 97',
+        'rtf': 'Rich Text Format',
+        'odt': 'writer8',
+        'html': 'HTML (StarWriter)',
+        'txt': 'Text',
+    }
+
+    def __init__(self, soffice='soffice', start_timeout=60):
+        try:
+            import uno
+        except ImportError:
+            raise SecretaryError('Could not import uno library. Install LibreOffice and its Python UNO bridge, i.e. "apt-get install python3-uno"')
+
+        self.profile = tempfile.mkdtemp(prefix='secretary-soffice-')
+        self.pipe = 'secretary-%s' % uuid4().hex
+        self.process = subprocess.Popen([
+            soffice, '--headless', '--invisible', '--nologo', '--nodefault',
+            '--norestore', '--nolockcheck',
+            '-env:UserInstallation=%s' % uno.systemPathToFileUrl(self.profile),
+            '--accept=pipe,name=%s;urp;StarOffice.ComponentContext' % self.pipe,
+        ])
+        self.desktop = self._connect(start_timeout)
+
+    def _connect(self, timeout):
+        # Connect to soffice, retrying until it accepts connections
+        import uno
+        from com.sun.star.connection import NoConnectException
+
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                context = resolver.resolve(
+                    'uno:pipe,name=%s;urp;StarOffice.ComponentContext' % self.pipe)
+                return context.ServiceManager.createInstanceWithContext(
+                    'com.sun.star.frame.Desktop', context)
+            except NoConnectException:
+                if self.process.poll() is not None:
+                    raise SecretaryError('soffice exited with status %s' %
+                                         self.process.returncode)
+                if time.time() > deadline:
+                    raise SecretaryError('Could not connect to soffice in %ss' %
+                                         timeout)
+                time.sleep(0.25)
+
+    @staticmethod
+    def _properties(**values):
+        from com.sun.star.beans import PropertyValue
+
+        properties = []
+        for name, value in values.items():
+            property = PropertyValue()
+            property.Name, property.Value = name, value
+            properties.append(property)
+
+        return tuple(properties)
+
+    def convert(self, input, output, format):
+        import uno
+
+        if format not in self.FILTERS:
+            raise SecretaryError('Unknown format "%s"' % format)
+
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(input), '_blank', 0,
+            self._properties(Hidden=True))
+        if document is None:
+            raise SecretaryError('LibreOffice could not load %s' % input)
+
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(output),
+                                self._properties(FilterName=self.FILTERS[format]))
+        finally:
+            document.close(True)
+
+    def close(self):
+        try:
+            self.desktop.terminate()
+        except Exception:
+            pass
+
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.profile, ignore_errors=True)
+
+
+def main(argv=None):
+    """
+        Run a LibreOffice converter process, see serve for its protocol.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Secretary converter process, converting documents with '
+                    'LibreOffice. Requests are read from standard input.')
+    parser.add_argument('--soffice', default='soffice',
+                        help='LibreOffice executable')
+    parser.add_argument('--start-timeout', type=float, default=60,
+                        help='Seconds LibreOffice has to start')
+    args = parser.parse_args(argv)
+
+    # Answers are written to the original standard output; anything else
+    # printed there, i.e. by LibreOffice, goes to standard error
+    output = io.open(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+
+    converter = LibreOfficeConverter(args.soffice, args.start_timeout)
+    try:
+        serve(converter.convert, io.open(0, 'r', encoding='utf-8'), output)
+    finally:
+        converter.close()
+
+
+if __name__ == "__main__":
+    main()
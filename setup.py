@@ -33,7 +33,8 @@ setup(
     author_email='chris.ramirezg@gmail.com',
     description='Take the power of Jinja2 templates to OpenOffice or LibreOffice.',
     long_description=long_description,
-    py_modules=['secretary', 'markdown_map'],
+    py_modules=['secretary', 'secretary_async', 'secretary_convert',
+                'markdown_map'],
     platforms='any',
     install_requires=[
         'Jinja2', 'markdown2'
@@ -51,7 +52,11 @@ setup(
         'Topic :: Office/Business',
         'Topic :: Utilities',
     ],
+    entry_points={
+        'console_scripts': ['secretary = secretary:main'],
+    },
     extras_require={
+        'lxml': ['lxml'],
         'testing': ['pytest']
     }
 )
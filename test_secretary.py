@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import io
 import os
+import json
+import re
+import sys
+import zipfile
 from xml.dom.minidom import getDOMImplementation
-from unittest import TestCase
-from secretary import UndefinedSilently, pad_string, Renderer
+from unittest import TestCase, skipIf
+from secretary import (UndefinedSilently, pad_string, Renderer, CompiledTemplate,
+                       SecretaryError)
 
 def test_undefined_silently():
     undefined = UndefinedSilently()
@@ -48,6 +54,46 @@ class RenderTestCase(TestCase):
         for test, expect in test_samples.items():
             assert self.engine._unescape_entities(test) == expect
 
+    def test__unescape_entities_matches_regex_rules(self):
+        # Unescape rules used before the single pass scanner
+        def regex_unescape(xml_text):
+            rules = [('&gt;', '>'), ('&lt;', '<'), ('&amp;', '&'),
+                     ('&quot;', '"'), ('&apos;', "'")]
+            for key, value in rules:
+                exp = re.compile(r'(?is)(({{|{%%)[^}}%%}]*?)(%s)([^{{{%%]*?(}}|%%}))' % key)
+                while True:
+                    xml_text, substitutions = exp.subn(r'\1%s\4' % value, xml_text)
+                    if not substitutions:
+                        break
+
+            return xml_text
+
+        test_samples = [
+            '<text:p>a &gt; b</text:p>{{ a &gt; b }}',
+            '{{ a &lt; b &amp;&amp; c &gt; d }}<text:p>&amp;</text:p>',
+            '{% if a == &quot;b&quot; %}&quot;{% endif %}{{ &apos;c&apos; }}',
+            '{{ a &amp;gt; b }}',
+            '&lt;{{ x }}&gt;{{ y &gt; 1 }}',
+            '{% for a in b %}<text:p>{{ a &gt; 0 }}</text:p>{% endfor %}',
+            '{{ unclosed &gt; tag',
+        ]
+
+        for test in test_samples:
+            assert self.engine._unescape_entities(test) == regex_unescape(test)
+
+    def test__unescape_entities_custom_delimiters(self):
+        from jinja2 import Environment
+
+        engine = Renderer(Environment(variable_start_string='[[',
+                                      variable_end_string=']]'))
+        assert engine._unescape_entities('[[ a &gt; b ]] {{ a &gt; b }}') == \
+            '[[ a > b ]] {{ a &gt; b }}'
+
+    def test__unescape_links(self):
+        assert self.engine._unescape_entities(
+            '<text:a xlink:href="secretary:%7B%7B%20url%20%7D%7D">') == \
+            '<text:a xlink:href="{{ url }}">'
+
     def test__encode_escape_chars(self):
         test_samples = {
             '<text:a>\n</text:a>': '<text:a><text:line-break/></text:a>',
@@ -64,6 +110,88 @@ class RenderTestCase(TestCase):
             assert self.engine._encode_escape_chars(test) == expect
 
 
+    def test_escape_chars_of_printed_values(self):
+        class Lines(object):
+            def __str__(self):
+                return 'a\nb'
+
+        template = self.engine.environment.from_string(
+            '<text:p><text:a xlink:href="{{ v }}"><text:span>{{ v }}</text:span>'
+            '</text:a>'
+            '<text:span>{{ lines }}</text:span></text:p>')
+        xml = self.engine._render_template(template, v='x\ty', lines=Lines())
+
+        assert xml == '<text:p><text:a xlink:href="x\ty">' \
+            '<text:span>x<text:tab/>y</text:span></text:a>' \
+            '<text:span>a<text:line-break/>b</text:span></text:p>'
+
+    def test__encode_escape_chars_scales_linearly(self):
+        from timeit import default_timer as timer
+
+        def encode_time(lines):
+            xml = '<text:p>' + 'a\n' * lines + \
+                '<text:span>b</text:span><text:span>c\n</text:span></text:p>'
+            times = []
+            for i in range(3):
+                start = timer()
+                self.engine._encode_escape_chars(xml)
+                times.append(timer() - start)
+
+            return min(times)
+
+        # 8 times more lines, 64 times slower if quadratic
+        assert encode_time(40000) < 24 * encode_time(5000)
+
+    def test__generate_template_escape_chars(self):
+        from jinja2 import Environment
+
+        engine = Renderer(Environment())
+        template = engine.environment.from_string(
+            '{% for v in values %}<text:p>{{ v }}</text:p>'
+            '<text:span>x{{ v }}</text:span>{% endfor %}')
+        values = ['a\nb', 'c\td', 'e', '\n\n']
+
+        expected = engine._encode_escape_chars(template.render(values=values))
+        for chunk_size in (1, 7, 30, 1000):
+            assert ''.join(engine._generate_template(
+                template, chunk_size, values=values)) == expected
+
+    def test__field_index(self):
+        from secretary import XML_BACKENDS
+
+        template = os.path.join(os.path.dirname(__file__), 'simple_template.odt')
+        content = zipfile.ZipFile(template).read('content.xml')
+        document = XML_BACKENDS['minidom'](content)
+
+        fields, counts = self.engine._field_index(document)
+        blocks = [field for field in fields if field[2]]
+
+        assert len(fields) == 15 and len(blocks) == 9
+        for field, content, is_block, scale_to, ancestors in fields:
+            assert document.tag(ancestors[-1]) == 'office:document-content'
+            assert counts[ancestors[-1]] == len(fields)
+
+    def test_markdown_writer(self):
+        from secretary import MarkdownWriter
+        from markdown_map import transform_map
+
+        writer = MarkdownWriter(transform_map)
+        writer.feed('<p>&copy; <a href="http://x?a=1&b=2">link</a> <b>bold</p>'
+                    '<ul><li>a<ul><li>b</li></ul></li></ul><p></p>')
+        writer.close()
+
+        assert writer.getvalue() == (
+            '<text:p text:style-name="Standard">\xa9 <text:a xlink:type="simple" '
+            'xlink:href="http://x?a=1&amp;b=2">link</text:a> '
+            '<text:span text:style-name="markdown_bold">bold</text:span></text:p>'
+            '<text:list xml:id="%s"><text:list-item><text:p>a</text:p>'
+            '<text:list xml:id="%s"><text:list-item><text:p>b</text:p>'
+            '</text:list-item></text:list></text:list-item></text:list>'
+            '<text:p text:style-name="Standard"/>' % (
+                transform_map['ul']['attributes']['xml:id'],
+                transform_map['ul']['attributes']['xml:id']))
+        assert [style[0] for style in writer.styles] == ['markdown_bold']
+
     def _test_is_jinja_tag(self):
         assert self._is_jinja_tag('{{ foo }}')==True
         assert self._is_jinja_tag('{ foo }')==False
@@ -79,3 +207,755 @@ class RenderTestCase(TestCase):
     def test_create_text_span_node(self):
         assert self.engine.create_text_span_node(self.document, 'text').toxml() == '<text:span>text</text:span>'
 
+
+class CompiledTemplateTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer()
+
+    def _content_of(self, document):
+        archive = zipfile.ZipFile(io.BytesIO(document))
+        return archive.read('content.xml').decode('utf-8')
+
+    def test_compiled_template_renders_many_times(self):
+        compiled = self.engine.compile(self.template)
+        assert isinstance(compiled, CompiledTemplate)
+
+        first = self._content_of(compiled.render(countries=[{'country': 'nicaragua'}]))
+        second = self._content_of(compiled.render(countries=[{'country': 'japan'}]))
+
+        assert 'Nicaragua' in first and 'Japan' not in first
+        assert 'Japan' in second and 'Nicaragua' not in second
+
+    def test_compiled_template_matches_render(self):
+        countries = [{'country': 'chile', 'capital': 'santiago'}]
+        compiled = self.engine.compile(self.template)
+
+        assert self._content_of(compiled.render(countries=countries)) == \
+            self._content_of(self.engine.render(self.template, countries=countries))
+
+    @skipIf(sys.version_info < (3, 5),
+            'zipfile writes into unseekable files since Python 3.5')
+    def test_render_to_unseekable_stream(self):
+        class Stream(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(bytes(data))
+                return len(data)
+
+            def flush(self):
+                pass
+
+        countries = [{'country': 'chile', 'capital': 'santiago'}]
+        stream = Stream()
+        self.engine.render_to(self.template, stream, countries=countries)
+
+        assert self._content_of(b''.join(stream.chunks)) == \
+            self._content_of(self.engine.render(self.template, countries=countries))
+
+    def test_stream_to(self):
+        countries = [{'country': 'chile', 'capital': 'santiago'}]
+        document = {'md_sample': '**a**'}
+        output = io.BytesIO()
+        self.engine.stream_to(self.template, output, countries=countries,
+                              document=document)
+
+        streamed = self._content_of(output.getvalue())
+        rendered = self._content_of(self.engine.render(
+            self.template, countries=countries, document=document))
+        assert Renderer._split_body(streamed)[1] == \
+            Renderer._split_body(rendered)[1]
+        assert 'style:name="markdown_bold"' in streamed
+
+    def test_stream_to_headers_match_central_directory(self):
+        import struct
+
+        def local_header(document, info):
+            # Version needed and extra field of the local header of `info`
+            start = info.header_offset
+            version, = struct.unpack('<H', document[start + 4:start + 6])
+            name_size, extra_size = struct.unpack(
+                '<HH', document[start + 26:start + 30])
+            extra = start + 30 + name_size
+            return version, document[extra:extra + extra_size]
+
+        countries = [{'country': 'chile', 'capital': 'santiago'}]
+        output = io.BytesIO()
+        self.engine.stream_to(self.template, output, countries=countries)
+        document = output.getvalue()
+
+        info = zipfile.ZipFile(io.BytesIO(document)).getinfo('content.xml')
+        assert local_header(document, info) == (info.extract_version,
+                                                info.extra)
+
+        # ZIP64 sizes, for members over 2 GiB, are only written on request
+        output = io.BytesIO()
+        self.engine.stream_to(self.template, output, zip64=True,
+                              countries=countries)
+        document = output.getvalue()
+        info = zipfile.ZipFile(io.BytesIO(document)).getinfo('content.xml')
+        assert local_header(document, info)[0] == 45
+
+    def test_stream_to_can_not_insert_styles(self):
+        def styled(value):
+            self.engine.register_style('custom_style',
+                                       **{'fo:font-weight': 'bold'})
+            return value
+
+        self.engine.environment.filters['title'] = styled
+        with self.assertRaises(SecretaryError):
+            self.engine.stream_to(self.template, io.BytesIO(),
+                                  countries=[{'country': 'chile'}])
+
+    def test_utf8_output(self):
+        countries = [{'country': '\u0645\u0635\u0631 \u4e2d\u56fd'}]
+        content = self._content_of(self.engine.render(self.template,
+                                                      countries=countries))
+        assert '\u0645\u0635\u0631 \u4e2d\u56fd'.upper() in content
+        assert '&#' not in content
+
+        engine = Renderer(ascii_output=True)
+        document = engine.render(self.template, countries=countries)
+        archive = zipfile.ZipFile(io.BytesIO(document))
+        for name in ('content.xml', 'styles.xml'):
+            archive.read(name).decode('ascii')
+        assert '&#1605;&#1589;&#1585;' in self._content_of(document)
+
+    def test_filters_can_insert_styles(self):
+        def styled(value):
+            if self.engine.get_style_by_name('custom_style') is None:
+                self.engine.insert_style_in_content(
+                    'custom_style', **{'fo:font-weight': 'bold'})
+            return value
+
+        self.engine.environment.filters['title'] = styled
+        content = self._content_of(self.engine.render(
+            self.template, countries=[{'country': 'chile'}, {'country': 'peru'}]))
+
+        assert content.count('style:name="custom_style"') == 1
+        assert 'chile' in content and 'peru' in content
+
+    def test_markdown_filter_cache(self):
+        compiled = self.engine.compile(self.template)
+        document = {'md_sample': '**bold** text'}
+
+        first = self._content_of(compiled.render(document=document))
+        assert len(self.engine.markdown_cache) == 1
+
+        self.engine._markdown_to_odt = None     # Must not be called again
+        second = self._content_of(compiled.render(document=document))
+
+        assert first == second
+        assert "b'" not in first
+        assert first.count('style:name="markdown_bold"') == 1
+        assert '<text:span text:style-name="markdown_bold">bold</text:span>' in first
+
+    def test_register_style(self):
+        def highlight(value):
+            node = self.engine.register_style(
+                'highlight', **{'fo:background-color': '#ffff00'})
+            assert self.engine.get_style_by_name('highlight') is node
+            return value
+
+        self.engine.environment.filters['title'] = highlight
+        countries = [{'country': 'chile'}, {'country': 'peru'}]
+        compiled = self.engine.compile(self.template)
+
+        for i in range(2):
+            content = self._content_of(compiled.render(countries=countries))
+            assert content.count('style:name="highlight"') == 1
+
+    def test_stats_callback(self):
+        reports = []
+        engine = Renderer(stats_callback=reports.append)
+        document = engine.render(self.template, countries=[{'country': 'chile'}],
+                                 document={'md_sample': '**a**'})
+
+        assert len(reports) == 1
+        stats = reports[0]
+        assert stats.operation == 'render'
+        assert set(['unpack', 'parse', 'prepare', 'compile', 'render',
+                    'pack']) <= set(stats.phases)
+        assert stats.counters['fields'] == 17
+        assert stats.counters['markdown_calls'] == 1
+        assert stats.counters['output_bytes'] == len(document)
+        assert stats.total >= sum(stats.phases.values())
+
+        compiled = engine.compile(self.template)
+        compiled.render(countries=[])
+        assert [stats.operation for stats in reports] == \
+            ['render', 'compile', 'render']
+        assert 'unpack' not in reports[-1].phases
+
+    def test_cache_dir(self):
+        import shutil
+        import tempfile
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        countries = [{'country': 'chile'}]
+
+        first = Renderer(cache_dir=cache_dir).render(self.template,
+                                                     countries=countries)
+        assert len(os.listdir(cache_dir)) == 3
+
+        engine = Renderer(cache_dir=cache_dir)
+        engine._prepare_xml = None      # Must not be called again
+        second = engine.render(self.template, countries=countries)
+        assert self._content_of(first) == self._content_of(second)
+
+        # A changed template gets its own entries
+        files = engine._unpack_template(self.template)
+        key = engine._template_cache_key(files)
+        files['content.xml'] += b' '
+        assert engine._template_cache_key(files) != key
+
+    def test_streaming_prepare(self):
+        # minidom sorts attributes before Python 3.8, lxml keeps their order
+        try:
+            import lxml
+        except ImportError:
+            self.skipTest('lxml is not installed')
+
+        compiled = Renderer(xml_backend='lxml').compile(self.template)
+        streamed = Renderer(streaming_prepare=True).compile(self.template)
+
+        assert streamed.content_head == compiled.content_head
+        assert streamed.content_source == compiled.content_source
+        assert streamed.styles_source == compiled.styles_source
+
+    def test_check_xml(self):
+        from markupsafe import Markup
+        from xml.parsers.expat import ExpatError
+
+        self.engine.environment.filters['title'] = lambda value: Markup('<broken')
+        self.engine.render(self.template, countries=[{'country': 'chile'}])
+
+        self.engine.check_xml = True
+        with self.assertRaises(ExpatError):
+            self.engine.render(self.template, countries=[{'country': 'chile'}])
+
+    def test_untouched_members_are_copied_compressed(self):
+        document = zipfile.ZipFile(io.BytesIO(self.engine.render(
+            self.template, countries=[{'country': 'chile'}])))
+        template = zipfile.ZipFile(self.template)
+
+        assert document.testzip() is None
+        assert document.namelist()[0] == 'mimetype'
+        for name in ('mimetype', 'Thumbnails/thumbnail.png', 'settings.xml'):
+            source, copied = template.getinfo(name), document.getinfo(name)
+            assert copied.compress_type == source.compress_type
+            assert copied.compress_size == source.compress_size
+            assert document.read(name) == template.read(name)
+
+    def test_render_many(self):
+        names = ['chile', 'peru', 'japan', 'nicaragua', 'england']
+        contexts = ({'countries': [{'country': name}]} for name in names)
+
+        results = dict(self.engine.render_many(self.template, contexts, workers=2))
+
+        assert sorted(results) == list(range(len(names)))
+        for index, name in enumerate(names):
+            assert name.title() in self._content_of(results[index])
+
+    def test_render_many_in_current_process(self):
+        compiled = self.engine.compile(self.template)
+        contexts = [{'countries': [{'country': 'chile'}]}]
+
+        index, document = next(compiled.render_many(contexts, workers=1))
+        assert index == 0 and 'Chile' in self._content_of(document)
+
+
+class CommandLineTestCase(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        self.template = os.path.join(os.path.dirname(__file__),
+                                     'simple_template.odt')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _write_contexts(self, lines):
+        contexts = os.path.join(self.directory, 'contexts.jsonl')
+        with io.open(contexts, 'w', encoding='utf-8') as output:
+            output.write('\n'.join(lines))
+
+        return contexts
+
+    def test_render_contexts_to_directory(self):
+        from secretary import main
+
+        contexts = self._write_contexts([
+            '{"name": "chile", "countries": [{"country": "chile"}]}',
+            '',
+            '{"countries": 1}',
+            'not json',
+            '{"countries": [{"country": "peru"}]}',
+            '{"name": "chile", "countries": [{"country": "peru"}]}',
+        ])
+        output = os.path.join(self.directory, 'output')
+        report = os.path.join(self.directory, 'report.jsonl')
+
+        assert main([self.template, contexts, '-o', output, '-n', 'name',
+                     '-w', '1', '-r', report]) == 1
+        assert sorted(os.listdir(output)) == ['5.odt', 'chile.odt']
+
+        with io.open(report, encoding='utf-8') as lines:
+            errors = dict((record['line'], record['error'])
+                          for record in map(json.loads, lines))
+        assert errors[1] is None and errors[5] is None
+        assert errors[3].startswith('TypeError')
+        assert errors[4].startswith('Invalid JSON')
+        assert errors[6] == 'Document chile.odt already exists'
+        with zipfile.ZipFile(os.path.join(output, 'chile.odt')) as document:
+            assert b'Chile' in document.read('content.xml')
+
+    def test_duplicate_names_before_other_records(self):
+        from secretary import main
+
+        contexts = self._write_contexts([
+            '{"name": "%s", "countries": [{"country": "%s"}]}' % (name, name)
+            for name in ['a', 'a', 'b', 'c']])
+        for workers in ('1', '2'):
+            output = os.path.join(self.directory, 'output' + workers)
+            assert main([self.template, contexts, '-o', output, '-n', 'name',
+                         '-w', workers]) == 1
+            assert sorted(os.listdir(output)) == ['a.odt', 'b.odt', 'c.odt']
+            for name in ['a', 'b', 'c']:
+                with zipfile.ZipFile(
+                        os.path.join(output, name + '.odt')) as document:
+                    content = document.read('content.xml')
+                assert name.capitalize().encode('ascii') in content
+
+    def test_numbered_document_does_not_overwrite_named_one(self):
+        import tarfile
+        from secretary import main
+
+        contexts = self._write_contexts([
+            '{"name": "3", "countries": [{"country": "chile"}]}',
+            '{"name": "x", "countries": [{"country": "peru"}]}',
+            '{"countries": [{"country": "bolivia"}]}',
+        ])
+        output = os.path.join(self.directory, 'output')
+        report = os.path.join(self.directory, 'report.jsonl')
+
+        assert main([self.template, contexts, '-o', output, '-n', 'name',
+                     '-w', '1', '-r', report]) == 1
+        assert sorted(os.listdir(output)) == ['3.odt', 'x.odt']
+        with zipfile.ZipFile(os.path.join(output, '3.odt')) as document:
+            assert b'Chile' in document.read('content.xml')
+        with io.open(report, encoding='utf-8') as lines:
+            records = [json.loads(line) for line in lines]
+        assert records[2] == {'line': 3, 'output': None,
+                              'error': 'Document 3.odt already exists'}
+
+        # A second run does not overwrite the documents of the first one
+        assert main([self.template, contexts, '-o', output, '-w', '1']) == 1
+        with zipfile.ZipFile(os.path.join(output, '3.odt')) as document:
+            assert b'Chile' in document.read('content.xml')
+
+        tar = os.path.join(self.directory, 'documents.tar')
+        assert main([self.template, contexts, '-t', tar, '-n', 'name',
+                     '-w', '1']) == 1
+        assert sorted(tarfile.open(tar).getnames()) == ['3.odt', 'x.odt']
+
+    def test_render_contexts_to_tar(self):
+        import tarfile
+        from secretary import main
+
+        contexts = self._write_contexts(
+            ['{"countries": [{"country": "c%d"}]}' % i for i in range(5)] +
+            ['{"countries": 1}'])
+        output = os.path.join(self.directory, 'documents.tar')
+
+        # Failed renders in worker processes do not stop the others
+        assert main([self.template, contexts, '-t', output, '-w', '2']) == 1
+        names = tarfile.open(output).getnames()
+        assert sorted(names) == ['%d.odt' % i for i in range(1, 6)]
+
+    def test_tar_writer_does_not_keep_members(self):
+        from secretary import _TarWriter
+
+        writer = _TarWriter(io.BytesIO())
+        for i in range(100):
+            writer.write('%d.odt' % i, b'document')
+            assert len(writer.tar.members) <= 1
+        writer.close()
+
+
+class MediaTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.template = self._repeat_image_template(
+            os.path.join(self.media_path, 'template.odt'), 3)
+
+    @staticmethod
+    def _repeat_image_template(filename, times):
+        # Returns a copy of template `filename` with its placeholder image
+        # paragraph repeated `times` times
+        source = zipfile.ZipFile(filename)
+        template = io.BytesIO()
+        target = zipfile.ZipFile(template, 'w')
+        for name in source.namelist():
+            data = source.read(name)
+            if name == 'content.xml':
+                content = data.decode('utf-8')
+                start = content.index('<text:p text:style-name="P2">')
+                end = content.index('</text:p>', start) + len('</text:p>')
+                paragraph = content[start:end]
+                content = content.replace(paragraph, paragraph * times)
+                data = content.encode('utf-8')
+            target.writestr(name, data)
+        target.close()
+
+        return template
+
+    def _new_pictures(self, archive):
+        return [name for name in archive.namelist()
+                if name.startswith('Pictures/') and name.endswith('.png') and
+                not name.startswith('Pictures/100002010000012C')]
+
+    def test_images_are_stored_once(self):
+        engine = Renderer(media_path=self.media_path)
+        archive = zipfile.ZipFile(io.BytesIO(
+            engine.render(self.template, image='writer.png')))
+
+        pictures = self._new_pictures(archive)
+        assert len(pictures) == 1
+
+        manifest = archive.read('META-INF/manifest.xml').decode('utf-8')
+        assert manifest.count(pictures[0]) == 1
+
+        content = archive.read('content.xml').decode('utf-8')
+        assert content.count(pictures[0]) == 3
+
+    def test_named_media_is_replaced(self):
+        engine = Renderer()
+        with engine._new_render_state():
+            engine._manifest_source = '<manifest:manifest xmlns:manifest=' \
+                '"urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"/>'
+
+            for data in (b'one', b'one', b'two'):
+                media_path = engine.add_media_to_archive(
+                    io.BytesIO(data), 'image/png', name='logo')
+
+            assert engine.files == {media_path: b'two'}
+            assert engine.manifest.toxml().count(media_path) == 1
+
+    def test_stream_to_rejects_images(self):
+        engine = Renderer(media_path=self.media_path)
+        with self.assertRaises(SecretaryError):
+            engine.stream_to(self.template, io.BytesIO(), image='writer.png')
+
+    def test_concurrent_renders(self):
+        import sys
+        import threading
+        from hashlib import sha1
+
+        with open(os.path.join(self.media_path, 'writer.png'), 'rb') as image:
+            picture = image.read()
+
+        engine = Renderer()
+
+        @engine.media_loader
+        def loader(value, *args, **kwargs):
+            return (io.BytesIO(picture + value.encode('ascii')), 'image/png')
+
+        compiled = engine.compile(self.template)
+        errors = []
+
+        def render(thread):
+            try:
+                for i in range(20):
+                    value = '%d-%d' % (thread, i)
+                    archive = zipfile.ZipFile(io.BytesIO(
+                        compiled.render(image=value)))
+
+                    expected = 'Pictures/%s.png' % sha1(
+                        picture + value.encode('ascii')).hexdigest()
+                    assert self._new_pictures(archive) == [expected]
+                    content = archive.read('content.xml').decode('utf-8')
+                    assert content.count(expected) == 3
+            except Exception as e:
+                errors.append(e)
+
+        # Switch threads as often as possible. Python 2 switches every
+        # number of bytecode instructions instead.
+        if hasattr(sys, 'getswitchinterval'):
+            get_interval, set_interval = (sys.getswitchinterval,
+                                          sys.setswitchinterval)
+            fastest = 1e-6
+        else:
+            get_interval, set_interval = (sys.getcheckinterval,
+                                          sys.setcheckinterval)
+            fastest = 1
+
+        interval = get_interval()
+        set_interval(fastest)
+        try:
+            threads = [threading.Thread(target=render, args=(i,))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            set_interval(interval)
+
+        assert errors == []
+
+    def test_render_state_is_not_kept_after_render(self):
+        import gc
+        import weakref
+        from secretary import _current_render
+
+        engine = Renderer(media_path=self.media_path)
+        engine.render(self.template, image='writer.png')
+        assert _current_render.get() is None
+        assert engine.pack_stats
+
+        renderer = weakref.ref(engine)
+        del engine
+        gc.collect()
+        assert renderer() is None
+
+    def test_media_cache(self):
+        engine = Renderer(media_path=self.media_path, media_cache_size=2**20)
+        calls = []
+
+        @engine.media_loader
+        def loader(value, *args, **kwargs):
+            calls.append(value)
+            kwargs['frame_attrs']['svg:width'] = '1in'
+            return engine.fs_loader(value, *args, **kwargs)
+
+        for i in range(2):
+            archive = zipfile.ZipFile(io.BytesIO(
+                engine.render(self.template, image='writer.png')))
+            content = archive.read('content.xml').decode('utf-8')
+
+            assert len(self._new_pictures(archive)) == 1
+            assert content.count('svg:width="1in"') == 3
+
+        assert calls == ['writer.png']
+
+    def test_raw_members_can_be_uncompressed(self):
+        from secretary import RawZipMember
+
+        self.template.seek(0)
+        archive = zipfile.ZipFile(self.template, 'r')
+        for info in archive.filelist:
+            member = RawZipMember.read(archive, info)
+            assert member.uncompressed() == archive.read(info.filename)
+
+    def test_compression_policy(self):
+        engine = Renderer(media_path=self.media_path)
+        archive = zipfile.ZipFile(io.BytesIO(
+            engine.render(self.template, image='writer.png')))
+        picture = self._new_pictures(archive)[0]
+
+        assert archive.getinfo(picture).compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo('content.xml').compress_type == zipfile.ZIP_DEFLATED
+
+        stats = dict((member['name'], member) for member in engine.pack_stats)
+        assert not stats[picture]['raw'] and stats['settings.xml']['raw']
+        assert stats['content.xml']['compress_size'] < stats['content.xml']['size']
+
+    def test_fast_compression_profile(self):
+        engine = Renderer(media_path=self.media_path, compression='fast')
+        archive = zipfile.ZipFile(io.BytesIO(
+            engine.render(self.template, image='writer.png')))
+
+        assert archive.testzip() is None
+        assert archive.getinfo('content.xml').compress_type == zipfile.ZIP_STORED
+
+    def test_lru_cache(self):
+        from secretary import LRUCache
+
+        cache = LRUCache(10)
+        cache.set('a', 'a', 4)
+        cache.set('b', 'b', 4)
+        cache.get('a')
+        cache.set('c', 'c', 4)
+        cache.set('d', 'd', 11)
+
+        assert cache.get('a') == 'a'
+        assert cache.get('b') is None
+        assert cache.get('c') == 'c'
+        assert cache.get('d') is None
+        assert cache.size == 8
+
+
+class FlatTemplateTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'samples', 'flat', 'template.fodt')
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.context = dict(
+            title='Report', name='Ana', notes='**bold** text', logo='writer.png',
+            countries=[{'name': 'Chile', 'capital': 'Santiago'},
+                       {'name': 'Per\u00fa', 'capital': 'Lima'}])
+
+    def test_render_flat_template(self):
+        from xml.dom.minidom import parseString
+
+        document = Renderer().render(self.template, **self.context)
+        root = parseString(document).documentElement
+
+        assert root.tagName == 'office:document'
+        assert [node.nodeName for node in root.childNodes
+                if node.nodeType == node.ELEMENT_NODE] == [
+            'office:meta', 'office:font-face-decls', 'office:styles',
+            'office:automatic-styles', 'office:master-styles', 'office:body']
+
+        xml = document.decode('utf-8')
+        assert '<text:span>Report</text:span></text:p></style:header>' in xml
+        assert 'Santiago' in xml and 'Per\u00fa' in xml
+        assert 'style:name="markdown_bold"' in xml
+        assert 'style:name="pm1"' in xml
+
+        body = xml.split('<office:text>')[1]
+        assert '<text:span text:style-name="markdown_bold">bold</text:span>' \
+            in body
+
+    def test_stream_flat_template(self):
+        import re
+        import shutil
+        import tempfile
+
+        # Images can not be streamed into the body
+        with self.assertRaises(SecretaryError):
+            Renderer().stream_to(self.template, io.BytesIO(), **self.context)
+
+        with io.open(self.template, encoding='utf-8') as template:
+            xml = re.sub(r'<text:p[^>]*><draw:frame.*?</text:p>', '',
+                         template.read())
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        template = os.path.join(directory, 'template.fodt')
+        with io.open(template, 'w', encoding='utf-8') as output:
+            output.write(xml)
+
+        # Both markdown styles are used, as stream_to inserts all of them
+        self.context['notes'] = '**bold** and *italic*'
+        compiled = Renderer().compile(template)
+        output = io.BytesIO()
+        compiled.stream_to(output, **self.context)
+        assert output.getvalue() == compiled.render(**self.context)
+
+    def test_flat_template_images_are_inlined(self):
+        import base64
+
+        engine = Renderer(media_path=self.media_path)
+        xml = engine.render(self.template, **self.context).decode('utf-8')
+
+        with open(os.path.join(self.media_path, 'writer.png'), 'rb') as image:
+            data = base64.b64encode(image.read()).decode('ascii')
+        assert '<draw:image><office:binary-data>%s</office:binary-data>' \
+            '</draw:image>' % data in xml
+        assert 'Pictures/' not in xml
+
+
+class XMLBackendTestCase(TestCase):
+    def setUp(self):
+        try:
+            import lxml
+        except ImportError:
+            self.skipTest('lxml is not installed')
+
+        self.template = os.path.join(os.path.dirname(__file__),
+                                     'simple_template.odt')
+
+    def test_backends_prepare_the_same_template(self):
+        minidom = Renderer(xml_backend='minidom').compile(self.template)
+        lxml = Renderer(xml_backend='lxml').compile(self.template)
+
+        assert minidom.content_head == lxml.content_head
+        assert minidom.content_source == lxml.content_source
+        assert minidom.styles_source == lxml.styles_source
+
+    def test_backends_keep_text_around_replaced_nodes(self):
+        from secretary import XML_BACKENDS
+
+        xml = ('<a xmlns:text="urn:text">x<b/>y<c/>z</a>').encode('ascii')
+        for backend in XML_BACKENDS.values():
+            document = backend(xml)
+            b, c = document.iter('b')[0], document.iter('c')[0]
+
+            document.insert_text(b, '1')
+            document.insert_text(b, '2', after=True)
+            document.insert_span(c, '3')
+            document.remove(b)
+            document.remove(c)
+
+            assert document.serialize() == \
+                '<?xml version="1.0" ?><a xmlns:text="urn:text">' \
+                'x12y<text:span>3</text:span>z</a>'
+
+    def test_streamed_document_prepares_like_lxml(self):
+        from secretary import XML_BACKENDS, StreamedDocument
+
+        def field(content, description=''):
+            return ('<text:text-input text:description="%s">%s'
+                    '</text:text-input>' % (description, content))
+
+        def row(*cells):
+            return '<table:table-row>%s</table:table-row>' % ''.join(
+                '<table:table-cell><text:p>%s</text:p></table:table-cell>' %
+                cell for cell in cells)
+
+        xml = ''.join([
+            '<?xml version="1.0" encoding="UTF-8"?><!-- top -->',
+            '<office:document xmlns:office="urn:office" a="x&#10;&lt;" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:table="urn:table"><office:body>',
+            '<text:p>Hi %s &amp; "you" &gt;<text:s/></text:p>' %
+            field('{{ name }}'),
+            '<table:table>',
+            row(field('{% for r in rows %}', 'table-row')),
+            row(field('{{ r.a }}') + '<!-- c -->', field('{{ r.b }}')),
+            row(field('{% endfor %}', 'table-row')),
+            '</table:table>',
+            '<text:p>%s</text:p><text:p>%s<text:span/></text:p>' % (
+                field('{% if x %}'), field('{% endif %}')),
+            '<text:p>%s</text:p><text:p>item</text:p><text:p>%s</text:p>' % (
+                field('{% for i in items %}', 'before::paragraph'),
+                field('{% endfor %}', 'after::paragraph')),
+            '<text:p>%s x</text:p><text:p>%s</text:p><text:p>%s</text:p>' % (
+                field('{{ md|markdown }}'), field('{{ a &lt; b }}'),
+                field('not jinja')),
+            '</office:body></office:document>',
+        ]).encode('utf-8')
+
+        engine = Renderer()
+        assert engine._prepare_xml(StreamedDocument(xml)) == \
+            engine._prepare_xml(XML_BACKENDS['lxml'](xml))
+
+    def test_backends_name_nodes_of_nested_namespaces(self):
+        from secretary import XML_BACKENDS
+
+        xml = '<a><b xmlns:x="urn:x" x:c="1"><x:d/></b></a>'.encode('ascii')
+        for backend in XML_BACKENDS.values():
+            document = backend(xml)
+            node = document.iter('b')[0]
+            assert document.attributes(node)['x:c'] == '1'
+            assert document.tag(document.first_child(node)) == 'x:d'
+            assert len(document.iter('x:d')) == 1
+
+            for name, value in document.attributes(node).items():
+                document.set(node, name, value + '2')
+            assert document.get(node, 'x:c') == '12'
+            document.remove_attribute(node, 'x:c')
+            assert document.get(node, 'x:c') == ''
+
+    def test_backends_accept_repeated_ids(self):
+        from secretary import XML_BACKENDS
+
+        xml = '<a><b xml:id="list1"/><b xml:id="list1"/></a>'.encode('ascii')
+        for backend in XML_BACKENDS.values():
+            assert len(backend(xml).iter('b')) == 2
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import os
+import zipfile
+from unittest import TestCase
+from secretary import Renderer
+
+ROOT = os.path.dirname(__file__)
+
+
+class RenderAsyncTestCase(TestCase):
+    def setUp(self):
+        self.engine = Renderer()
+
+    def _read(self, document, name):
+        archive = zipfile.ZipFile(io.BytesIO(document))
+        return archive.read(name).decode('utf-8')
+
+    def test_awaitable_context_values(self):
+        async def country():
+            await asyncio.sleep(0)
+            return [{'country': 'nicaragua'}]
+
+        template = os.path.join(ROOT, 'simple_template.odt')
+        document = asyncio.run(self.engine.render_async(template,
+                                                        countries=country()))
+
+        assert 'Nicaragua' in self._read(document, 'content.xml')
+
+    def test_async_media_loader(self):
+        image_path = os.path.join(ROOT, 'samples', 'images', 'writer.png')
+        loaded = []
+
+        @self.engine.media_loader
+        async def loader(value, *args, **kwargs):
+            await asyncio.sleep(0)
+            loaded.append(value)
+            return open(image_path, 'rb'), 'image/png'
+
+        template = os.path.join(ROOT, 'samples', 'images', 'template.odt')
+        document = asyncio.run(self.engine.render_async(template,
+                                                        image='writer.png'))
+
+        assert loaded == ['writer.png']
+        archive = zipfile.ZipFile(io.BytesIO(document))
+        pictures = [name for name in archive.namelist()
+                    if name.startswith('Pictures/') and name.endswith('.png')]
+        with open(image_path, 'rb') as image:
+            assert image.read() in [archive.read(name) for name in pictures]
+
+    def test_sync_render_rejects_async_loader(self):
+        from secretary import SecretaryError
+
+        @self.engine.media_loader
+        async def loader(value, *args, **kwargs):
+            return None
+
+        template = os.path.join(ROOT, 'samples', 'images', 'template.odt')
+        with self.assertRaises(SecretaryError):
+            self.engine.render(template, image='writer.png')
+
+    def test_concurrent_renders(self):
+        with open(os.path.join(ROOT, 'samples', 'images', 'writer.png'), 'rb') as image:
+            picture = image.read()
+
+        @self.engine.media_loader
+        async def loader(value, *args, **kwargs):
+            await asyncio.sleep(0)
+            return io.BytesIO(picture + value.encode('ascii')), 'image/png'
+
+        template = os.path.join(ROOT, 'samples', 'images', 'template.odt')
+        compiled = self.engine.compile(template)
+
+        async def render_all():
+            return await asyncio.gather(*[
+                compiled.render_async(image=str(i)) for i in range(10)])
+
+        for i, document in enumerate(asyncio.run(render_all())):
+            archive = zipfile.ZipFile(io.BytesIO(document))
+            images = [archive.read(name) for name in archive.namelist()
+                      if name.startswith('Pictures/')]
+            assert picture + str(i).encode('ascii') in images
+            assert len(images) == 2
+
+    def test_templates_are_compiled_once(self):
+        from jinja2 import Environment
+
+        reports = []
+        engine = Renderer(stats_callback=reports.append)
+        compiles = []
+        compile = Environment.compile
+
+        def compile_source(environment, source, *args, **kwargs):
+            compiles.append(environment.is_async)
+            return compile(environment, source, *args, **kwargs)
+
+        template = os.path.join(ROOT, 'simple_template.odt')
+        Environment.compile = compile_source
+        try:
+            asyncio.run(engine.render_async(template, countries=[]))
+        finally:
+            Environment.compile = compile
+
+        assert compiles == [True, True]
+        assert [stats.operation for stats in reports] == ['render']
+        assert reports[0].phases['compile'] > 0
+
+    def test_cache_dir(self):
+        import shutil
+        import tempfile
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        template = os.path.join(ROOT, 'simple_template.odt')
+        countries = [{'country': 'chile'}]
+
+        first = asyncio.run(Renderer(cache_dir=cache_dir).render_async(
+            template, countries=countries))
+        assert len(os.listdir(cache_dir)) == 3
+
+        # The async code is loaded from the bytecode cache
+        engine = Renderer(cache_dir=cache_dir)
+        engine.environment.compile = None
+        second = asyncio.run(engine.render_async(template,
+                                                 countries=countries))
+        assert self._read(first, 'content.xml') == \
+            self._read(second, 'content.xml')
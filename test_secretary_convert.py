@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from unittest import TestCase, skipIf
+from secretary import Renderer
+
+
+# A converter process "converting" documents by prefixing them with the
+# format. Documents starting with "sleep" or "crash" make it hang or exit.
+STUB_CONVERTER = """
+import sys, time
+sys.path.insert(0, %r)
+from secretary_convert import serve
+
+def convert(input, output, format):
+    data = open(input, 'rb').read()
+    if data.startswith(b'sleep'):
+        time.sleep(30)
+    if data.startswith(b'crash'):
+        sys.exit(1)
+    if data.startswith(b'fail'):
+        raise ValueError('bad document')
+    open(output, 'wb').write(format.encode('ascii') + b':' + data)
+
+serve(convert, sys.stdin, sys.stdout)
+"""
+
+
+@skipIf(sys.version_info < (3,), 'secretary_convert requires Python 3')
+class ConverterTestCase(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        stub = os.path.join(directory, 'stub_converter.py')
+        with open(stub, 'w') as output:
+            output.write(STUB_CONVERTER % os.path.dirname(
+                os.path.abspath(__file__)))
+
+        self.command = [sys.executable, stub]
+
+    def _pool(self, **kwargs):
+        from secretary_convert import ConverterPool
+
+        pool = ConverterPool(self.command, start_timeout=10, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_render_and_convert(self):
+        from secretary_convert import render_and_convert
+
+        pool = self._pool()
+        template = os.path.join(os.path.dirname(__file__), 'simple_template.odt')
+        document = render_and_convert(template, pool, format='pdf',
+                                      countries=[{'country': 'chile'}])
+        assert document.startswith(b'pdf:PK')
+
+        compiled = Renderer().compile(template)
+        document = render_and_convert(compiled, pool, format='docx',
+                                      countries=[])
+        assert document.startswith(b'docx:PK')
+        assert pool.counters['started'] == 1
+
+    def test_recycle_after_max_jobs(self):
+        pool = self._pool(max_jobs=2)
+        for i in range(5):
+            assert pool.convert(b'doc', 'txt') == b'txt:doc'
+
+        assert pool.counters['started'] == 3
+        assert pool.counters['recycled'] == 2
+
+    def test_failed_conversions(self):
+        from secretary_convert import ConversionError, ConversionTimeout
+
+        pool = self._pool(timeout=0.5)
+        with self.assertRaises(ConversionError):
+            pool.convert(b'fail', 'pdf')
+        with self.assertRaises(ConversionTimeout):
+            pool.convert(b'sleep', 'pdf')
+        with self.assertRaises(ConversionError):
+            pool.convert(b'crash', 'pdf')
+
+        # Killed and exited processes are replaced
+        assert pool.convert(b'doc', 'pdf') == b'pdf:doc'
+        assert pool.counters['timeouts'] == 1
+        assert pool.counters['started'] == 3
+
+    def test_health_check_replaces_dead_process(self):
+        pool = self._pool(health_check_interval=0)
+        assert pool.convert(b'doc', 'pdf') == b'pdf:doc'
+
+        process = list(pool._processes)[0]
+        process.kill()
+        assert pool.convert(b'doc', 'pdf') == b'pdf:doc'
+        assert pool.counters['replaced'] == 1
+
+    def test_close_during_conversion(self):
+        pool = self._pool()
+        process = pool._acquire()
+        pool.close()
+
+        pool._release(process)
+        assert not process.alive()
+
+    def test_queue_timeout(self):
+        from secretary_convert import ConversionTimeout
+
+        pool = self._pool(queue_timeout=0.1)
+        process = pool._acquire()
+        with self.assertRaises(ConversionTimeout):
+            pool.convert(b'doc', 'pdf')
+        pool._release(process)
+        assert os.listdir(pool.work_dir) == []
+
+    def test_close_while_waiting_for_a_process(self):
+        import time
+        import threading
+        from secretary_convert import ConversionError
+
+        pool = self._pool()
+        process = pool._acquire()
+        errors = []
+
+        def convert():
+            try:
+                pool.convert(b'doc', 'pdf')
+            except ConversionError as e:
+                errors.append(e)
+
+        waiting = threading.Thread(target=convert)
+        waiting.start()
+        time.sleep(0.2)
+        pool.close()
+        pool._release(process)
+        waiting.join()
+
+        assert len(errors) == 1
+        assert pool.counters['started'] == 1